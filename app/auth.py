@@ -3,13 +3,21 @@ OAuth 2.0 authentication handler for delegated user access.
 Handles Microsoft login, token management, and user session.
 """
 
+import base64
+import hashlib
+import heapq
 import logging
-import json
 import secrets
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, List, Protocol, Tuple
 from urllib.parse import urlencode, parse_qs, urlparse
-import requests
+import httpx
+import orjson
+from cachetools import TLRUCache, TTLCache
+
+from app.graph_client import GraphClient, get_http_client, parse_json
 
 logger = logging.getLogger(__name__)
 
@@ -17,24 +25,29 @@ logger = logging.getLogger(__name__)
 class OAuthSession:
     """Stores user OAuth tokens and metadata."""
     
-    def __init__(self, access_token: str, refresh_token: str, expires_at: datetime, user_id: str, user_email: str):
+    __slots__ = ("access_token", "refresh_token", "expires_at", "user_id", "user_email", "created_at")
+    
+    # Tokens are treated as expired this many seconds early
+    EXPIRY_MARGIN_SECONDS = 300
+    
+    def __init__(self, access_token: str, refresh_token: str, expires_at: float, user_id: str, user_email: str):
         self.access_token = access_token
         self.refresh_token = refresh_token
-        self.expires_at = expires_at
+        self.expires_at = expires_at  # Epoch seconds
         self.user_id = user_id
         self.user_email = user_email
         self.created_at = datetime.utcnow()
     
     def is_expired(self) -> bool:
         """Check if token is expired."""
-        return datetime.utcnow() >= self.expires_at - timedelta(minutes=5)
+        return time.time() >= self.expires_at - self.EXPIRY_MARGIN_SECONDS
     
     def to_dict(self) -> Dict[str, Any]:
         """Serialize session to dict for storage."""
         return {
             "access_token": self.access_token,
             "refresh_token": self.refresh_token,
-            "expires_at": self.expires_at.isoformat(),
+            "expires_at": self.expires_at,
             "user_id": self.user_id,
             "user_email": self.user_email,
             "created_at": self.created_at.isoformat()
@@ -43,13 +56,146 @@ class OAuthSession:
     @staticmethod
     def from_dict(data: Dict[str, Any]) -> "OAuthSession":
         """Deserialize session from dict."""
-        return OAuthSession(
+        expires_at = data["expires_at"]
+        if isinstance(expires_at, str):
+            # Sessions stored before expiry became epoch seconds
+            expires_at = datetime.fromisoformat(expires_at).replace(tzinfo=timezone.utc).timestamp()
+        session = OAuthSession(
             access_token=data["access_token"],
             refresh_token=data["refresh_token"],
-            expires_at=datetime.fromisoformat(data["expires_at"]),
+            expires_at=expires_at,
             user_id=data["user_id"],
             user_email=data["user_email"]
         )
+        if data.get("created_at"):
+            session.created_at = datetime.fromisoformat(data["created_at"])
+        return session
+
+
+class SessionStore(Protocol):
+    """Storage backend for OAuth sessions, keyed by user ID."""
+
+    def get(self, user_id: str) -> Optional[OAuthSession]:
+        ...
+
+    def set(self, user_id: str, session: OAuthSession) -> None:
+        ...
+
+    def delete(self, user_id: str) -> None:
+        ...
+
+
+class InMemorySessionStore:
+    """Process-local session store (sessions are lost on restart)."""
+
+    def __init__(self):
+        self._sessions: Dict[str, OAuthSession] = {}
+
+    def get(self, user_id: str) -> Optional[OAuthSession]:
+        return self._sessions.get(user_id)
+
+    def set(self, user_id: str, session: OAuthSession) -> None:
+        self._sessions[user_id] = session
+
+    def delete(self, user_id: str) -> None:
+        self._sessions.pop(user_id, None)
+
+
+class _RemoteSessionStore:
+    """Base for stores that keep serialized sessions in an external cache."""
+
+    KEY_PREFIX = "oauth_session:"
+    # Delegated refresh tokens live up to 90 days
+    TTL_SECONDS = 90 * 24 * 3600
+
+    def _key(self, user_id: str) -> str:
+        return f"{self.KEY_PREFIX}{user_id}"
+
+    @staticmethod
+    def _dumps(session: OAuthSession) -> bytes:
+        return orjson.dumps(session.to_dict())
+
+    @staticmethod
+    def _loads(data: Optional[bytes]) -> Optional[OAuthSession]:
+        if not data:
+            return None
+        return OAuthSession.from_dict(orjson.loads(data))
+
+
+class MemcachedSessionStore(_RemoteSessionStore):
+    """Session store sharded across Memcached servers with consistent hashing."""
+
+    def __init__(self, servers: list):
+        """
+        Args:
+            servers: List of (host, port) tuples
+        """
+        try:
+            from pymemcache.client.hash import HashClient
+        except ImportError:
+            raise RuntimeError("MemcachedSessionStore requires the 'pymemcache' package")
+        self._client = HashClient(servers)
+
+    def get(self, user_id: str) -> Optional[OAuthSession]:
+        return self._loads(self._client.get(self._key(user_id)))
+
+    def set(self, user_id: str, session: OAuthSession) -> None:
+        self._client.set(self._key(user_id), self._dumps(session), expire=self.TTL_SECONDS)
+
+    def delete(self, user_id: str) -> None:
+        self._client.delete(self._key(user_id))
+
+
+class RedisSessionStore(_RemoteSessionStore):
+    """Session store backed by Redis."""
+
+    def __init__(self, url: str):
+        """
+        Args:
+            url: Redis connection URL (redis://host:port/db)
+        """
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RedisSessionStore requires the 'redis' package")
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, user_id: str) -> Optional[OAuthSession]:
+        return self._loads(self._client.get(self._key(user_id)))
+
+    def set(self, user_id: str, session: OAuthSession) -> None:
+        self._client.set(self._key(user_id), self._dumps(session), ex=self.TTL_SECONDS)
+
+    def delete(self, user_id: str) -> None:
+        self._client.delete(self._key(user_id))
+
+
+def create_session_store(url: Optional[str] = None) -> SessionStore:
+    """
+    Build a session store from a connection URL.
+
+    Args:
+        url: ``redis://...``, ``memcached://host1:port,host2:port`` or None for in-memory
+
+    Returns:
+        SessionStore instance
+    """
+    if not url:
+        return InMemorySessionStore()
+
+    parsed = urlparse(url)
+    if parsed.scheme in ("redis", "rediss"):
+        logger.info("Using Redis session store")
+        return RedisSessionStore(url)
+    if parsed.scheme == "memcached":
+        servers = []
+        for server in parsed.netloc.split(","):
+            host, _, port = server.partition(":")
+            servers.append((host, int(port or 11211)))
+        logger.info("Using Memcached session store with %s servers", len(servers))
+        return MemcachedSessionStore(servers)
+
+    raise ValueError(f"Unsupported session store URL: {url}")
 
 
 class OAuthHandler:
@@ -66,13 +212,40 @@ class OAuthHandler:
         "offline_access"  # For refresh token
     ]
     
-    def __init__(self, tenant_id: str, client_id: str, client_secret: str, redirect_uri: str):
+    # Sessions expiring within this many seconds are refreshed in the background
+    REFRESH_WINDOW_SECONDS = 600
+    # /me results are cached for the default access token lifetime
+    USER_INFO_TTL_SECONDS = 3600
+    # Must stay below OAuthSession.EXPIRY_MARGIN_SECONDS so cached tokens are never stale
+    TOKEN_CACHE_TTL_SECONDS = 60
+    
+    def __init__(self, tenant_id: str, client_id: str, client_secret: str, redirect_uri: str,
+                 store: Optional[SessionStore] = None):
         self.tenant_id = tenant_id
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
-        # In-memory session store (in production, use database)
-        self.sessions: Dict[str, OAuthSession] = {}
+        # Fixed for the handler's lifetime, so build them once
+        self._scope = " ".join(self.SCOPES)
+        self._authorize_url = self.OAUTH_AUTHORIZE_URL.format(tenant_id=tenant_id)
+        self._token_url = self.OAUTH_TOKEN_URL.format(tenant_id=tenant_id)
+        # Session store shared by all app instances (defaults to in-memory)
+        self.store: SessionStore = store if store is not None else InMemorySessionStore()
+        # Min-heap of (expires_at, user_id) for proactive refresh
+        self._expiry_heap: List[Tuple[float, str]] = []
+        self._heap_lock = threading.Lock()
+        # Per-user locks so concurrent refreshes collapse into one token request
+        self._refresh_locks: Dict[str, threading.Lock] = {}
+        self._refresh_locks_guard = threading.Lock()
+        # (user_id, email) keyed by SHA-256 of the access token, never the token itself
+        self._user_info_cache: TTLCache = TTLCache(maxsize=1024, ttl=self.USER_INFO_TTL_SECONDS)
+        # Short-lived user_id -> access token cache in front of the session store
+        self._token_cache: TTLCache = TTLCache(maxsize=10000, ttl=self.TOKEN_CACHE_TTL_SECONDS)
+        self._token_cache_lock = threading.Lock()
+        # user_id -> (access token, GraphClient, expires_at); an entry lives until its token expires
+        self._client_cache: TLRUCache = TLRUCache(
+            maxsize=1024, ttu=lambda _user_id, entry, _now: entry[2], timer=time.time
+        )
         logger.info("OAuth handler initialized")
     
     def get_authorization_url(self, state: Optional[str] = None) -> tuple[str, str]:
@@ -90,15 +263,14 @@ class OAuthHandler:
             "response_type": "code",
             "redirect_uri": self.redirect_uri,
             "response_mode": "query",
-            "scope": " ".join(self.SCOPES),
+            "scope": self._scope,
             "state": state,
             "prompt": "select_account"
         }
         
-        auth_url = self.OAUTH_AUTHORIZE_URL.format(tenant_id=self.tenant_id)
-        url = f"{auth_url}?{urlencode(params)}"
+        url = f"{self._authorize_url}?{urlencode(params)}"
         
-        logger.info(f"Generated authorization URL for state: {state}")
+        logger.info("Generated authorization URL for state: %s", state)
         return url, state
     
     def exchange_code_for_token(self, code: str) -> Optional[OAuthSession]:
@@ -111,30 +283,30 @@ class OAuthHandler:
         Returns:
             OAuthSession with tokens and user info, or None if failed
         """
-        token_url = self.OAUTH_TOKEN_URL.format(tenant_id=self.tenant_id)
-        
         data = {
             "client_id": self.client_id,
             "client_secret": self.client_secret,
             "code": code,
             "redirect_uri": self.redirect_uri,
             "grant_type": "authorization_code",
-            "scope": " ".join(self.SCOPES)
+            "scope": self._scope
         }
         
         try:
             logger.info("Exchanging authorization code for tokens")
-            response = requests.post(token_url, data=data, timeout=10)
+            response = get_http_client().post(self._token_url, data=data, timeout=10)
             response.raise_for_status()
             
-            token_data = response.json()
+            token_data = parse_json(response)
             access_token = token_data["access_token"]
             refresh_token = token_data.get("refresh_token")
             expires_in = token_data.get("expires_in", 3600)
-            expires_at = datetime.utcnow() + timedelta(seconds=expires_in)
+            expires_at = time.time() + expires_in
             
-            # Get user info
-            user_id, user_email = self._get_user_info(access_token)
+            # Get user info from the token claims, falling back to /me
+            user_id, user_email = self._user_from_claims(access_token)
+            if not user_id or not user_email:
+                user_id, user_email = self._get_user_info(access_token)
             
             if not user_id or not user_email:
                 logger.error("Failed to get user info")
@@ -149,13 +321,15 @@ class OAuthHandler:
             )
             
             # Store session
-            self.sessions[user_id] = session
+            self.store.set(user_id, session)
+            self._forget_token(user_id)
+            self._schedule_refresh(session)
             
-            logger.info(f"Successfully authenticated user: {user_email}")
+            logger.info("Successfully authenticated user: %s", user_email)
             return session
             
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Token exchange failed: {e}")
+        except httpx.HTTPError as e:
+            logger.error("Token exchange failed: %s", e)
             return None
     
     def refresh_access_token(self, user_id: str) -> Optional[OAuthSession]:
@@ -168,40 +342,55 @@ class OAuthHandler:
         Returns:
             Updated OAuthSession, or None if failed
         """
-        session = self.sessions.get(user_id)
+        session = self.store.get(user_id)
         if not session or not session.refresh_token:
-            logger.warning(f"No refresh token for user: {user_id}")
+            logger.warning("No refresh token for user: %s", user_id)
             return None
         
-        token_url = self.OAUTH_TOKEN_URL.format(tenant_id=self.tenant_id)
-        
+        seen_expiry = session.expires_at
+        with self._refresh_lock(user_id):
+            # Another caller may have refreshed while we waited for the lock
+            current = self.store.get(user_id)
+            if current and current.expires_at != seen_expiry:
+                logger.debug("Token already refreshed for user: %s", user_id)
+                return current
+            return self._refresh_session(current or session)
+    
+    def _refresh_session(self, session: OAuthSession) -> Optional[OAuthSession]:
+        """Exchange the session's refresh token for a new access token."""
+        user_id = session.user_id
         data = {
             "client_id": self.client_id,
             "client_secret": self.client_secret,
             "refresh_token": session.refresh_token,
             "grant_type": "refresh_token",
-            "scope": " ".join(self.SCOPES)
+            "scope": self._scope
         }
         
         try:
-            logger.info(f"Refreshing token for user: {user_id}")
-            response = requests.post(token_url, data=data, timeout=10)
+            logger.info("Refreshing token for user: %s", user_id)
+            response = get_http_client().post(self._token_url, data=data, timeout=10)
             response.raise_for_status()
             
-            token_data = response.json()
+            token_data = parse_json(response)
             access_token = token_data["access_token"]
             expires_in = token_data.get("expires_in", 3600)
-            expires_at = datetime.utcnow() + timedelta(seconds=expires_in)
+            expires_at = time.time() + expires_in
             
             # Update session
             session.access_token = access_token
             session.expires_at = expires_at
+            # Refresh tokens may be rotated by the token endpoint
+            session.refresh_token = token_data.get("refresh_token", session.refresh_token)
+            self.store.set(user_id, session)
+            self._forget_token(user_id)
+            self._schedule_refresh(session)
             
-            logger.info(f"Token refreshed for user: {user_id}")
+            logger.info("Token refreshed for user: %s", user_id)
             return session
             
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Token refresh failed: {e}")
+        except httpx.HTTPError as e:
+            logger.error("Token refresh failed: %s", e)
             return None
     
     def get_valid_token(self, user_id: str) -> Optional[str]:
@@ -214,9 +403,14 @@ class OAuthHandler:
         Returns:
             Valid access token, or None if unavailable
         """
-        session = self.sessions.get(user_id)
+        with self._token_cache_lock:
+            token = self._token_cache.get(user_id)
+        if token:
+            return token
+        
+        session = self.store.get(user_id)
         if not session:
-            logger.warning(f"No session found for user: {user_id}")
+            logger.warning("No session found for user: %s", user_id)
             return None
         
         if session.is_expired():
@@ -225,17 +419,131 @@ class OAuthHandler:
                 return None
             session = refreshed
         
+        with self._token_cache_lock:
+            self._token_cache[user_id] = session.access_token
         return session.access_token
     
+    def get_graph_client(self, user_id: str) -> Optional[GraphClient]:
+        """
+        Get a Graph client that acts with the user's delegated token.
+        
+        Clients are cached per user until their token expires or is replaced.
+        All of them share the process-wide HTTP connection pool.
+        
+        Args:
+            user_id: User ID
+            
+        Returns:
+            GraphClient, or None if the user has no valid token
+        """
+        token = self.get_valid_token(user_id)
+        if not token:
+            return None
+        
+        with self._token_cache_lock:
+            cached = self._client_cache.get(user_id)
+        if cached and cached[0] == token:
+            return cached[1]
+        
+        session = self.store.get(user_id)
+        if session and session.access_token == token:
+            expires_at = session.expires_at - OAuthSession.EXPIRY_MARGIN_SECONDS
+        else:
+            expires_at = time.time() + self.TOKEN_CACHE_TTL_SECONDS
+        client = GraphClient(self.tenant_id, self.client_id, self.client_secret, user_token=token)
+        with self._token_cache_lock:
+            self._client_cache[user_id] = (token, client, expires_at)
+        return client
+    
+    def _forget_token(self, user_id: str) -> None:
+        """Drop a user's cached access token (and the client using it) after it changes."""
+        with self._token_cache_lock:
+            self._token_cache.pop(user_id, None)
+            self._client_cache.pop(user_id, None)
+    
+    def _refresh_lock(self, user_id: str) -> threading.Lock:
+        """Get (or lazily create) the refresh lock for a user."""
+        with self._refresh_locks_guard:
+            lock = self._refresh_locks.get(user_id)
+            if lock is None:
+                lock = self._refresh_locks[user_id] = threading.Lock()
+            return lock
+    
+    def _schedule_refresh(self, session: OAuthSession) -> None:
+        """Track session expiry so it can be refreshed before it lapses."""
+        with self._heap_lock:
+            heapq.heappush(self._expiry_heap, (session.expires_at, session.user_id))
+    
+    def refresh_expiring_sessions(self, window: Optional[float] = None) -> int:
+        """
+        Refresh sessions whose access token expires within the window.
+        
+        Args:
+            window: Look-ahead window in seconds (defaults to REFRESH_WINDOW_SECONDS)
+            
+        Returns:
+            Number of sessions refreshed
+        """
+        deadline = time.time() + (window or self.REFRESH_WINDOW_SECONDS)
+        due = []
+        with self._heap_lock:
+            while self._expiry_heap and self._expiry_heap[0][0] <= deadline:
+                due.append(heapq.heappop(self._expiry_heap))
+        
+        refreshed = 0
+        for expires_at, user_id in due:
+            session = self.store.get(user_id)
+            # Skip users who logged out or whose token was refreshed since
+            if not session or session.expires_at != expires_at:
+                continue
+            if self.refresh_access_token(user_id):
+                refreshed += 1
+        
+        if refreshed:
+            logger.info("Proactively refreshed %s sessions", refreshed)
+        return refreshed
+    
     def get_session(self, user_id: str) -> Optional[OAuthSession]:
         """Get session for user."""
-        return self.sessions.get(user_id)
+        return self.store.get(user_id)
     
     def logout(self, user_id: str) -> None:
         """Remove session for user."""
-        if user_id in self.sessions:
-            del self.sessions[user_id]
-            logger.info(f"User logged out: {user_id}")
+        session = self.store.get(user_id)
+        if session:
+            self._user_info_cache.pop(self._token_key(session.access_token), None)
+        self.store.delete(user_id)
+        self._forget_token(user_id)
+        with self._refresh_locks_guard:
+            self._refresh_locks.pop(user_id, None)
+        logger.info("User logged out: %s", user_id)
+    
+    @staticmethod
+    def _user_from_claims(access_token: str) -> tuple[Optional[str], Optional[str]]:
+        """
+        Read user ID and email from the access token's JWT payload.
+        
+        The signature is not verified: the token was just received from the
+        Microsoft token endpoint over TLS.
+        
+        Returns:
+            Tuple of (user_id, email) or (None, None) if the token has no usable claims
+        """
+        try:
+            payload = access_token.split(".")[1]
+            claims = orjson.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        except (IndexError, ValueError) as e:
+            logger.debug("Access token claims unavailable: %s", e)
+            return None, None
+        
+        user_id = claims.get("oid")
+        email = claims.get("upn") or claims.get("preferred_username")
+        return user_id, email
+    
+    @staticmethod
+    def _token_key(access_token: str) -> str:
+        """Cache key for a token that does not keep the secret in memory."""
+        return hashlib.sha256(access_token.encode("utf-8")).hexdigest()
     
     def _get_user_info(self, access_token: str) -> tuple[Optional[str], Optional[str]]:
         """
@@ -244,19 +552,27 @@ class OAuthHandler:
         Returns:
             Tuple of (user_id, email) or (None, None) if failed
         """
+        cache_key = self._token_key(access_token)
+        cached = self._user_info_cache.get(cache_key)
+        if cached:
+            logger.debug("Using cached user info")
+            return cached
+        
         headers = {"Authorization": f"Bearer {access_token}"}
         
         try:
-            response = requests.get(self.GRAPH_ME_URL, headers=headers, timeout=10)
+            response = get_http_client().get(self.GRAPH_ME_URL, headers=headers, timeout=10)
             response.raise_for_status()
             
-            user_data = response.json()
+            user_data = parse_json(response)
             user_id = user_data.get("id")
             email = user_data.get("userPrincipalName") or user_data.get("mail")
             
-            logger.info(f"Retrieved user info: {email}")
+            logger.info("Retrieved user info: %s", email)
+            if user_id and email:
+                self._user_info_cache[cache_key] = (user_id, email)
             return user_id, email
             
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to get user info: {e}")
+        except httpx.HTTPError as e:
+            logger.error("Failed to get user info: %s", e)
             return None, None
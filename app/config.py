@@ -0,0 +1,34 @@
+"""
+Application settings loaded from environment variables and .env.
+"""
+
+from functools import cache
+from typing import Optional
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    """Application settings from environment variables."""
+    
+    tenant_id: str
+    client_id: str
+    client_secret: str
+    ngrok_url: str
+    client_state_secret: str
+    disable_oauth_state_validation: bool = False
+    db_path: str = "sqlite:///./teams_mvp.db"
+    log_level: str = "INFO"
+    oauth_redirect_uri: str = "https://teamspoc.onrender.com/auth/callback"
+    session_store_url: Optional[str] = None
+    # Graph requests the worker has in flight at once (each $batch call counts once)
+    worker_concurrency: int = 8
+    
+    # Read once at startup; frozen so handlers can rely on it never changing
+    model_config = SettingsConfigDict(env_file=".env", case_sensitive=False, frozen=True)
+
+
+@cache
+def get_settings() -> Settings:
+    """Load settings on first call and return the same instance afterwards."""
+    return Settings()
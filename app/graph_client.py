@@ -1,194 +1,552 @@
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from functools import lru_cache
+from itertools import islice
+from typing import Optional, Dict, Any, List, Iterable, Iterator, Mapping
+import asyncio
 import logging
-import requests
+import random
+import re
+import threading
+import time
+import httpx
+import orjson
 
 logger = logging.getLogger(__name__)
 
+# Connection pool sizing shared by every GraphClient in the process
+POOL_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=100)
+REQUEST_TIMEOUT = 30
+CONNECT_RETRIES = 3  # Transport-level retries for failed connection attempts
+
+_http_client: Optional[httpx.Client] = None
+_async_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.Client:
+    """Get the shared keep-alive HTTP client, creating it on first use."""
+    global _http_client
+    if _http_client is None:
+        transport = httpx.HTTPTransport(http2=True, limits=POOL_LIMITS, retries=CONNECT_RETRIES)
+        _http_client = httpx.Client(transport=transport, timeout=REQUEST_TIMEOUT)
+    return _http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Get the shared keep-alive async HTTP client, creating it on first use."""
+    global _async_http_client
+    if _async_http_client is None:
+        transport = httpx.AsyncHTTPTransport(http2=True, limits=POOL_LIMITS, retries=CONNECT_RETRIES)
+        _async_http_client = httpx.AsyncClient(transport=transport, timeout=REQUEST_TIMEOUT)
+    return _async_http_client
+
+
+# Scheme/host and API version in front of a Graph resource path
+_GRAPH_PREFIX_RE = re.compile(r"^(?:https?://[^/]+)?/?(?:v1\.0|beta)/")
+
+
+@lru_cache(maxsize=4096)
+def _normalize_resource_path(resource_path: str) -> str:
+    """Reduce a notification resource or URL to a Graph path."""
+    return "/" + _GRAPH_PREFIX_RE.sub("", resource_path).lstrip("/")
+
+
+def _expiry_iso(hours: float) -> str:
+    """Format now + hours as a Graph expirationDateTime (UTC, 7-digit fraction)."""
+    t = time.gmtime(time.time() + hours * 3600)
+    return (f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}"
+            f"T{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}.0000000Z")
+
+
+def parse_json(response: httpx.Response) -> Any:
+    """Decode a JSON response body with orjson."""
+    return orjson.loads(response.content)
+
+
+async def close_http_clients() -> None:
+    """Close the shared HTTP clients (called on application shutdown)."""
+    global _http_client, _async_http_client
+    if _async_http_client is not None:
+        await _async_http_client.aclose()
+        _async_http_client = None
+    if _http_client is not None:
+        _http_client.close()
+        _http_client = None
+
+
+class BearerAuth(httpx.Auth):
+    """Attach a bearer token header that is built once per token, not per request."""
+
+    def __init__(self, token: Optional[str] = None):
+        self.header = f"Bearer {token}" if token else ""
+
+    def set_token(self, token: str) -> None:
+        """Rebuild the header after the token rotates."""
+        self.header = f"Bearer {token}"
+
+    def auth_flow(self, request: httpx.Request):
+        request.headers["Authorization"] = self.header
+        yield request
+
 
 class GraphClient:
     """Client for Microsoft Graph API with app-only authentication."""
-    
+
     GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
     TOKEN_URL = "https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-    
+    MAX_RETRIES = 3
+    RETRY_DELAY = 1
+    RETRY_JITTER = 1.0  # Upper bound of the random delay added to each backoff
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+    BATCH_MAX_REQUESTS = 20  # Graph rejects $batch payloads with more steps
+    BATCH_RETRY_STATUSES = (429, 503, 504)
+    TOKEN_REFRESH_MARGIN = 600  # Refresh app tokens 10 minutes before expiry
+    TOKEN_EXPIRY_MARGIN = 300  # Treat tokens as expired 5 minutes early
+
     def __init__(self, tenant_id: str, client_id: str, client_secret: str, user_token: Optional[str] = None):
         self.tenant_id = tenant_id
         self.client_id = client_id
         self.client_secret = client_secret
+        self._token_url = self.TOKEN_URL.format(tenant_id=tenant_id)
         self._token: Optional[str] = user_token  # User token takes precedence
-        self._token_expiry: Optional[datetime] = None
+        self._token_expiry: Optional[float] = None  # time.monotonic() deadline
         self._is_user_token = user_token is not None  # Flag to track if using user token
-        logger.info(f"Graph client initialized (user_token: {self._is_user_token})")
-    
-    def get_access_token(self, force_refresh: bool = False) -> str:
-        """Get valid access token, refreshing if necessary."""
+        self._auth = BearerAuth(user_token)
+        self._token_lock = threading.Lock()
+        self._async_token_lock: Optional[asyncio.Lock] = None  # Created on first use inside the event loop
+        logger.info("Graph client initialized (user_token: %s)", self._is_user_token)
+
+    def _cached_token(self, force_refresh: bool) -> Optional[str]:
+        """Return the current token if it can be used without a refresh."""
         # If using user token, just return it (user tokens are managed by OAuth handler)
         if self._is_user_token:
             if self._token:
                 return self._token
             raise Exception("User token not available")
-        
-        # App-only token logic
+
         if not force_refresh and self._token and self._token_expiry:
-            if datetime.utcnow() < self._token_expiry - timedelta(minutes=5):
+            if time.monotonic() < self._token_expiry - self.TOKEN_EXPIRY_MARGIN:
                 logger.debug("Using cached access token")
                 return self._token
-        
-        logger.info("Acquiring new access token")
-        token_url = self.TOKEN_URL.format(tenant_id=self.tenant_id)
-        
-        data = {
+        return None
+
+    def _token_request_data(self) -> Dict[str, str]:
+        """Form body for the client credentials grant."""
+        return {
             "client_id": self.client_id,
             "client_secret": self.client_secret,
             "scope": "https://graph.microsoft.com/.default",
             "grant_type": "client_credentials"
         }
-        
-        try:
-            response = requests.post(token_url, data=data, timeout=10)
-            response.raise_for_status()
-            
-            token_data = response.json()
-            self._token = token_data["access_token"]
-            expires_in = token_data.get("expires_in", 3600)
-            self._token_expiry = datetime.utcnow() + timedelta(seconds=expires_in)
-            
-            logger.info(f"Access token acquired, expires in {expires_in}s")
+
+    def _store_token(self, token_data: Dict[str, Any]) -> str:
+        """Cache a token endpoint response on the client."""
+        self._token = token_data["access_token"]
+        self._auth.set_token(self._token)
+        expires_in = token_data.get("expires_in", 3600)
+        self._token_expiry = time.monotonic() + expires_in
+        logger.info("Access token acquired, expires in %ss", expires_in)
+        return self._token
+
+    def _refreshed_since(self, seen_token: Optional[str], force_refresh: bool) -> Optional[str]:
+        """Return a token acquired by another caller while this one waited on the lock."""
+        if self._token and self._token != seen_token:
             return self._token
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to acquire access token: {e}")
-            raise Exception(f"Token acquisition failed: {e}")
-    
-    def _make_request(self, method: str, url: str, **kwargs) -> requests.Response:
-        """Make authenticated request to Graph API with retry logic."""
+        return self._cached_token(force_refresh)
+
+    def get_access_token(self, force_refresh: bool = False) -> str:
+        """Get valid access token, refreshing if necessary."""
+        token = self._cached_token(force_refresh)
+        if token:
+            return token
+
+        # Single-flight: concurrent callers wait for one token request
+        seen_token = self._token
+        with self._token_lock:
+            token = self._refreshed_since(seen_token, force_refresh)
+            if token:
+                return token
+
+            logger.info("Acquiring new access token")
+            try:
+                response = get_http_client().post(self._token_url, data=self._token_request_data(), timeout=10)
+                response.raise_for_status()
+                return self._store_token(parse_json(response))
+
+            except httpx.HTTPError as e:
+                logger.error("Failed to acquire access token: %s", e)
+                raise Exception(f"Token acquisition failed: {e}")
+
+    async def get_access_token_async(self, force_refresh: bool = False) -> str:
+        """Async variant of get_access_token."""
+        token = self._cached_token(force_refresh)
+        if token:
+            return token
+
+        if self._async_token_lock is None:
+            self._async_token_lock = asyncio.Lock()
+
+        seen_token = self._token
+        async with self._async_token_lock:
+            token = self._refreshed_since(seen_token, force_refresh)
+            if token:
+                return token
+
+            logger.info("Acquiring new access token")
+            try:
+                response = await get_async_http_client().post(self._token_url, data=self._token_request_data(), timeout=10)
+                response.raise_for_status()
+                return self._store_token(parse_json(response))
+
+            except httpx.HTTPError as e:
+                logger.error("Failed to acquire access token: %s", e)
+                raise Exception(f"Token acquisition failed: {e}")
+
+    async def keep_token_fresh(self, margin: int = TOKEN_REFRESH_MARGIN) -> None:
+        """
+        Refresh the app-only token in the background before it expires.
+
+        Runs until cancelled, so requests never wait on the token endpoint.
+
+        Args:
+            margin: Seconds before expiry to refresh
+        """
+        if self._is_user_token:
+            return
+
+        while True:
+            delay = 0.0
+            if self._token_expiry:
+                remaining = self._token_expiry - time.monotonic()
+                delay = max(remaining - margin, 30)
+            await asyncio.sleep(delay)
+            try:
+                await self.get_access_token_async(force_refresh=True)
+            except Exception as e:
+                logger.error("Background token refresh failed: %s", e)
+                await asyncio.sleep(60)
+
+    def _build_url(self, url: str) -> str:
+        """Resolve a Graph path against the v1.0 base URL."""
         if not url.startswith("http"):
             url = f"{self.GRAPH_BASE_URL}{url}"
-        
-        token = self.get_access_token()
+        return url
+
+    @staticmethod
+    def _error_detail(e: httpx.HTTPError) -> str:
+        """Extract the Graph error body from a failed request, if any."""
+        response = getattr(e, "response", None)
+        if response is None:
+            return ""
+        try:
+            return f" - Details: {parse_json(response)}"
+        except orjson.JSONDecodeError:
+            return f" - Response: {response.text[:200]}"
+
+    @staticmethod
+    def _encode_json_body(kwargs: Dict[str, Any], headers: Dict[str, str]) -> None:
+        """Serialize a ``json=`` request body with orjson."""
+        if "json" in kwargs:
+            kwargs["content"] = orjson.dumps(kwargs.pop("json"))
+            headers["Content-Type"] = "application/json"
+
+    @staticmethod
+    def _retry_after(headers: Mapping[str, str]) -> Optional[float]:
+        """Seconds requested by a Retry-After header; None if missing or not in seconds (e.g. an HTTP date)."""
+        try:
+            return float(headers["Retry-After"])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _retry_delay(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        """
+        Seconds to wait before retrying a failed request.
+
+        Honours Retry-After when Graph sends one, otherwise backs off
+        exponentially. Random jitter keeps parallel workers from retrying
+        in lockstep.
+
+        Args:
+            attempt: Zero-based attempt number that just failed
+            response: Response that triggered the retry, if any
+
+        Returns:
+            Delay in seconds
+        """
+        delay = self.RETRY_DELAY * (2 ** attempt)
+        retry_after = self._retry_after(response.headers) if response is not None else None
+        if retry_after is not None:
+            delay = retry_after
+        return delay + random.uniform(0, self.RETRY_JITTER)
+
+    def _make_request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Make authenticated request to Graph API with retry logic."""
+        url = self._build_url(url)
+
+        self.get_access_token()  # Refreshes the token behind self._auth if needed
         headers = kwargs.pop("headers", {})
-        headers["Authorization"] = f"Bearer {token}"
-        
-        max_retries = 3
-        retry_delay = 1
-        
+        self._encode_json_body(kwargs, headers)
+
+        client = get_http_client()
+        max_retries = self.MAX_RETRIES
+
         for attempt in range(max_retries):
+            retries_left = attempt < max_retries - 1
             try:
-                response = requests.request(method, url, headers=headers, timeout=30, **kwargs)
-                
-                if response.status_code == 429:
-                    retry_after = int(response.headers.get("Retry-After", 60))
-                    logger.warning(f"Rate limited, retry after {retry_after}s")
-                    if attempt < max_retries - 1:
-                        import time
-                        time.sleep(retry_after)
-                        continue
-                
-                if response.status_code == 401 and attempt < max_retries - 1:
+                response = client.request(method, url, headers=headers, auth=self._auth, **kwargs)
+
+                if response.status_code == 401 and retries_left:
                     logger.warning("Unauthorized, refreshing token")
                     self.get_access_token(force_refresh=True)
-                    token = self._token
-                    headers["Authorization"] = f"Bearer {token}"
                     continue
-                
+
+                if response.status_code in self.RETRY_STATUSES and retries_left:
+                    delay = self._retry_delay(attempt, response)
+                    logger.warning("Graph returned %s, retrying in %.1fs", response.status_code, delay)
+                    time.sleep(delay)
+                    continue
+
+                response.raise_for_status()
+                return response
+
+            except httpx.HTTPStatusError as e:
+                error_detail = self._error_detail(e)
+                logger.error("Request failed (attempt %s/%s): %s%s", attempt + 1, max_retries, e, error_detail)
+                raise Exception(f"Request failed after {attempt + 1} attempts: {e}{error_detail}")
+
+            except httpx.HTTPError as e:
+                logger.error("Request failed (attempt %s/%s): %s", attempt + 1, max_retries, e)
+                if not retries_left:
+                    raise Exception(f"Request failed after {max_retries} attempts: {e}")
+                time.sleep(self._retry_delay(attempt))
+
+        raise Exception("Request failed")
+
+    async def _make_request_async(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Async variant of _make_request; retries without blocking the event loop."""
+        url = self._build_url(url)
+
+        await self.get_access_token_async()  # Refreshes the token behind self._auth if needed
+        headers = kwargs.pop("headers", {})
+        self._encode_json_body(kwargs, headers)
+
+        client = get_async_http_client()
+        max_retries = self.MAX_RETRIES
+
+        for attempt in range(max_retries):
+            retries_left = attempt < max_retries - 1
+            try:
+                response = await client.request(method, url, headers=headers, auth=self._auth, **kwargs)
+
+                if response.status_code == 401 and retries_left:
+                    logger.warning("Unauthorized, refreshing token")
+                    await self.get_access_token_async(force_refresh=True)
+                    continue
+
+                if response.status_code in self.RETRY_STATUSES and retries_left:
+                    delay = self._retry_delay(attempt, response)
+                    logger.warning("Graph returned %s, retrying in %.1fs", response.status_code, delay)
+                    await asyncio.sleep(delay)
+                    continue
+
                 response.raise_for_status()
                 return response
-                
-            except requests.exceptions.RequestException as e:
-                # Log detailed error response if available
-                error_detail = ""
-                if hasattr(e, 'response') and e.response is not None:
-                    try:
-                        error_json = e.response.json()
-                        error_detail = f" - Details: {error_json}"
-                    except:
-                        error_detail = f" - Response: {e.response.text[:200]}"
-                
-                logger.error(f"Request failed (attempt {attempt + 1}/{max_retries}): {e}{error_detail}")
-                if attempt < max_retries - 1:
-                    import time
-                    time.sleep(retry_delay * (2 ** attempt))
-                else:
-                    raise Exception(f"Request failed after {max_retries} attempts: {e}{error_detail}")
-        
+
+            except httpx.HTTPStatusError as e:
+                error_detail = self._error_detail(e)
+                logger.error("Request failed (attempt %s/%s): %s%s", attempt + 1, max_retries, e, error_detail)
+                raise Exception(f"Request failed after {attempt + 1} attempts: {e}{error_detail}")
+
+            except httpx.HTTPError as e:
+                logger.error("Request failed (attempt %s/%s): %s", attempt + 1, max_retries, e)
+                if not retries_left:
+                    raise Exception(f"Request failed after {max_retries} attempts: {e}")
+                await asyncio.sleep(self._retry_delay(attempt))
+
         raise Exception("Request failed")
-    
+
     def get_message(self, resource_path: str) -> Dict[str, Any]:
         """Fetch Teams message from Graph API."""
-        logger.info(f"Fetching message from {resource_path}")
-        
-        if resource_path.startswith("https://"):
-            from urllib.parse import urlparse
-            resource_path = urlparse(resource_path).path
-        
-        if "/v1.0/" in resource_path:
-            resource_path = resource_path.split("/v1.0/", 1)[1]
-        elif "/beta/" in resource_path:
-            resource_path = resource_path.split("/beta/", 1)[1]
-        
-        if not resource_path.startswith("/"):
-            resource_path = f"/{resource_path}"
-        
-        response = self._make_request("GET", resource_path)
-        message_data = response.json()
-        logger.info(f"Successfully fetched message {message_data.get('id')}")
+        logger.info("Fetching message from %s", resource_path)
+        response = self._make_request("GET", _normalize_resource_path(resource_path))
+        message_data = parse_json(response)
+        logger.info("Successfully fetched message %s", message_data.get('id'))
         return message_data
-    
-    def create_subscription(self, resource: str, notification_url: str, 
-                           client_state: str, expiration_hours: int = 1) -> Dict[str, Any]:
-        """Create Graph change notification subscription."""
+
+    async def get_messages_async(self, resource_paths: List[str]) -> List[Dict[str, Any]]:
+        """
+        Fetch several Teams messages with batched requests.
+
+        Returns:
+            Batch sub-responses in the order of resource_paths
+        """
+        logger.info("Fetching %s messages", len(resource_paths))
+        return await self.batch_async([
+            {"method": "GET", "url": _normalize_resource_path(resource_path)}
+            for resource_path in resource_paths
+        ])
+
+    async def get_chat_messages_async(self, chat_id: str, top: int = 50) -> List[Dict[str, Any]]:
+        """Fetch the most recent messages in a chat (first page only)."""
+        response = await self._make_request_async("GET", f"/me/chats/{chat_id}/messages", params={"$top": top})
+        return parse_json(response).get("value", [])
+
+    @staticmethod
+    def _subscription_payload(resource: str, notification_url: str,
+                              client_state: str, expiration_hours: int) -> Dict[str, Any]:
+        """Build the request body for a new subscription."""
         # Microsoft limits delegated channel subscriptions to 3 days (72 hours)
         # Use a slightly lower value to account for processing time
         max_minutes = 4300  # Slightly under 72 hours (4320 minutes) for safety
         expiration_minutes = min(expiration_hours * 60, max_minutes)
-        
-        expiration = datetime.utcnow() + timedelta(minutes=expiration_minutes)
-        expiration_str = expiration.strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
-        
+
         subscription_data = {
             "changeType": "created,updated",
             "notificationUrl": notification_url,
             "resource": resource,
-            "expirationDateTime": expiration_str,
+            "expirationDateTime": _expiry_iso(expiration_minutes / 60),
             "clientState": client_state
         }
-        
+
         # For subscriptions longer than 1 hour, add lifecycle notification URL
         if expiration_hours > 1:
             subscription_data["lifecycleNotificationUrl"] = notification_url
-        
-        logger.info(f"Creating subscription for {resource}")
-        response = self._make_request("POST", "/subscriptions", json=subscription_data)
-        subscription = response.json()
-        logger.info(f"Created subscription {subscription.get('id')}")
-        return subscription
-        logger.info(f"Creating subscription for {resource}")
+        return subscription_data
+
+    def create_subscription(self, resource: str, notification_url: str,
+                           client_state: str, expiration_hours: int = 1) -> Dict[str, Any]:
+        """Create Graph change notification subscription."""
+        subscription_data = self._subscription_payload(resource, notification_url, client_state, expiration_hours)
+
+        logger.info("Creating subscription for %s", resource)
         response = self._make_request("POST", "/subscriptions", json=subscription_data)
-        subscription = response.json()
-        logger.info(f"Created subscription {subscription.get('id')}")
+        subscription = parse_json(response)
+        logger.info("Created subscription %s", subscription.get('id'))
         return subscription
-    
+
+    @staticmethod
+    def _renewal_payload(expiration_hours: int) -> Dict[str, str]:
+        """Build the PATCH body for a subscription renewal."""
+        return {"expirationDateTime": _expiry_iso(expiration_hours)}
+
     def renew_subscription(self, subscription_id: str, expiration_hours: int = 1) -> Dict[str, Any]:
         """Renew existing subscription."""
-        expiration = datetime.utcnow() + timedelta(hours=expiration_hours)
-        expiration_str = expiration.strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
-        
-        logger.info(f"Renewing subscription {subscription_id}")
-        response = self._make_request("PATCH", f"/subscriptions/{subscription_id}", 
-                                     json={"expirationDateTime": expiration_str})
-        return response.json()
-    
+        logger.info("Renewing subscription %s", subscription_id)
+        response = self._make_request("PATCH", f"/subscriptions/{subscription_id}",
+                                     json=self._renewal_payload(expiration_hours))
+        return parse_json(response)
+
     def delete_subscription(self, subscription_id: str) -> None:
         """Delete subscription."""
-        logger.info(f"Deleting subscription {subscription_id}")
+        logger.info("Deleting subscription %s", subscription_id)
         self._make_request("DELETE", f"/subscriptions/{subscription_id}")
-        logger.info(f"Deleted subscription {subscription_id}")
-    
+        logger.info("Deleted subscription %s", subscription_id)
+
+    def iter_subscriptions(self) -> Iterator[Dict[str, Any]]:
+        """Yield active subscriptions page by page, following @odata.nextLink."""
+        url: Optional[str] = "/subscriptions"
+        while url:
+            page = parse_json(self._make_request("GET", url))
+            yield from page.get("value", [])
+            url = page.get("@odata.nextLink")
+
     def list_subscriptions(self) -> list:
         """List all active subscriptions."""
         logger.info("Listing subscriptions")
-        response = self._make_request("GET", "/subscriptions")
-        subscriptions = response.json().get("value", [])
-        logger.info(f"Found {len(subscriptions)} subscriptions")
+        subscriptions = list(self.iter_subscriptions())
+        logger.info("Found %s subscriptions", len(subscriptions))
         return subscriptions
+
+    @staticmethod
+    def _batch_request(index: int, step: Dict[str, Any]) -> Dict[str, Any]:
+        """Convert a batch step into a JSON batch request entry."""
+        request = {"id": str(index), "method": step["method"], "url": step["url"]}
+        headers = step.get("headers")
+        if step.get("body") is not None:
+            request["body"] = step["body"]
+            headers = {"Content-Type": "application/json", **(headers or {})}
+        if headers:
+            request["headers"] = headers
+        return request
+
+    def _batch_envelopes(self, steps: List[Dict[str, Any]], indexes: Iterable[int]) -> Iterable[Dict[str, Any]]:
+        """Yield $batch request bodies holding at most BATCH_MAX_REQUESTS steps each."""
+        indexes = iter(indexes)
+        while True:
+            chunk = list(islice(indexes, self.BATCH_MAX_REQUESTS))
+            if not chunk:
+                return
+            yield {"requests": [self._batch_request(i, steps[i]) for i in chunk]}
+
+    def _collect_batch_responses(self, body: Dict[str, Any], results: List[Optional[Dict[str, Any]]],
+                                 retry: List[int]) -> float:
+        """
+        Store sub-responses by step index and queue throttled steps for retry.
+
+        Returns:
+            Longest Retry-After (seconds) requested by a throttled step
+        """
+        delay = 0
+        for sub_response in body.get("responses", []):
+            index = int(sub_response["id"])
+            results[index] = sub_response
+            if sub_response.get("status") in self.BATCH_RETRY_STATUSES:
+                retry.append(index)
+                retry_after = self._retry_after(sub_response.get("headers") or {})
+                delay = max(delay, self.RETRY_DELAY if retry_after is None else retry_after)
+        return delay
+
+    def batch(self, steps: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Send requests through the Graph JSON batching endpoint.
+
+        Steps are dicts with ``method`` and ``url`` (relative to the API version,
+        e.g. ``/subscriptions/{id}``) and optional ``body`` and ``headers``. They are
+        split into $batch calls of up to 20 steps; throttled steps are retried.
+
+        Args:
+            steps: Requests to send
+
+        Returns:
+            Sub-responses (``id``, ``status``, ``headers``, ``body``) in step order
+        """
+        results: List[Optional[Dict[str, Any]]] = [None] * len(steps)
+        pending: List[int] = list(range(len(steps)))
+
+        for attempt in range(self.MAX_RETRIES):
+            retry: List[int] = []
+            delay = 0
+            for envelope in self._batch_envelopes(steps, pending):
+                logger.info("Sending batch of %s requests", len(envelope['requests']))
+                response = self._make_request("POST", "/$batch", json=envelope)
+                delay = max(delay, self._collect_batch_responses(parse_json(response), results, retry))
+
+            if not retry or attempt == self.MAX_RETRIES - 1:
+                break
+            logger.warning("%s batch steps throttled, retry after %ss", len(retry), delay)
+            time.sleep(delay)
+            pending = sorted(retry)
+
+        return results
+
+    async def batch_async(self, steps: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Async variant of batch; the $batch calls for one round are sent concurrently."""
+        results: List[Optional[Dict[str, Any]]] = [None] * len(steps)
+        pending: List[int] = list(range(len(steps)))
+
+        for attempt in range(self.MAX_RETRIES):
+            retry: List[int] = []
+            envelopes = list(self._batch_envelopes(steps, pending))
+            logger.info("Sending %s batches for %s requests", len(envelopes), len(pending))
+            responses = await asyncio.gather(*[
+                self._make_request_async("POST", "/$batch", json=envelope) for envelope in envelopes
+            ])
+            delay = 0
+            for response in responses:
+                delay = max(delay, self._collect_batch_responses(parse_json(response), results, retry))
+
+            if not retry or attempt == self.MAX_RETRIES - 1:
+                break
+            logger.warning("%s batch steps throttled, retry after %ss", len(retry), delay)
+            await asyncio.sleep(delay)
+            pending = sorted(retry)
+
+        return results
@@ -3,26 +3,30 @@ FastAPI application for receiving Microsoft Graph webhook notifications.
 """
 
 import os
-import json
+import asyncio
 import logging
-from json import JSONDecodeError
 from contextlib import asynccontextmanager
-from typing import Optional, Dict
+from datetime import datetime
+from typing import Optional, Dict, Iterator
+from urllib.parse import urlsplit
 
-from fastapi import FastAPI, Request, Response, HTTPException, status
-from fastapi.responses import PlainTextResponse, RedirectResponse
+from fastapi import FastAPI, Query, Request, Response, HTTPException, status
+from fastapi.responses import ORJSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import ValidationError
-from pydantic_settings import BaseSettings
 from dotenv import load_dotenv
-
-from app.storage import init_db, get_message_by_id, get_db, Message, save_notification, save_message
-from app.auth import OAuthHandler
+from sqlalchemy import bindparam, select
+from sqlalchemy.exc import OperationalError
+import orjson
+from cachetools import TTLCache
+
+from app.config import Settings, get_settings
+from app.storage import init_db, get_message_by_id, get_db, Message, save_notifications_bulk, save_messages_bulk, delete_notifications
+from app.auth import OAuthHandler, create_session_store
 from app.utils import setup_logging, validate_client_state
-from app.worker import start_worker, stop_worker
-from app.graph_client import GraphClient
-from app.schema import NotificationCollection, SubscriptionCreateRequest
+from app.worker import start_worker, stop_worker, notify_new_work
+from app.graph_client import GraphClient, close_http_clients, parse_json
+from app.schema import GraphNotification, SubscriptionCreateRequest
 from app.schema import normalize_message
 from app.subscription import (
     create_teams_subscription,
@@ -30,8 +34,6 @@ from app.subscription import (
     delete_subscription as delete_subscription_fn,
 )
 import hmac
-import hashlib
-from app.schema import NotificationCollection
 
 # Load environment variables
 load_dotenv()
@@ -39,31 +41,110 @@ load_dotenv()
 logger = logging.getLogger(__name__)
 
 
-class Settings(BaseSettings):
-    """Application settings from environment variables."""
-    
-    tenant_id: str
-    client_id: str
-    client_secret: str
-    ngrok_url: str
-    client_state_secret: str
-    disable_oauth_state_validation: bool = False
-    db_path: str = "sqlite:///./teams_mvp.db"
-    log_level: str = "INFO"
-    oauth_redirect_uri: str = "https://teamspoc.onrender.com/auth/callback"
-    
-    class Config:
-        env_file = ".env"
-        case_sensitive = False
-
-
 # Global settings instance
 settings: Optional[Settings] = None
 oauth_handler: Optional[OAuthHandler] = None
-# State tokens for CSRF protection
-oauth_states: set = set()
+# Webhook URL handed to Graph for new subscriptions (built once at startup)
+notification_url: Optional[str] = None
+# OAuth states already redeemed at /auth/callback; entries outlive the 600s state cookie
+_used_oauth_states: TTLCache = TTLCache(maxsize=10000, ttl=600)
+# client_state_secret as bytes, for webhook client state checks and OAuth state signing
+client_state_key: Optional[bytes] = None
 # Mapping of subscription_id -> creator_user_id for delegated permissions
 subscription_creators: Dict[str, str] = {}
+# Validated webhook batches waiting to be written to the database. The webhook
+# answers 202 once a batch is queued and Graph doesn't redeliver after a 2xx,
+# so queued batches are retried while the database is busy and flushed on shutdown
+NOTIFICATION_QUEUE_SIZE = 10000
+SAVE_BATCH_MAX = 500
+SAVE_RETRY_DELAY = 1
+SAVE_RETRY_MAX_DELAY = 30
+SAVE_MAX_ATTEMPTS = 8
+SHUTDOWN_SAVE_TIMEOUT = 30
+notification_queue: Optional[asyncio.Queue] = None
+_save_task: Optional[asyncio.Task] = None
+
+
+def _save_notifications_one_by_one(batch: list) -> None:
+    """Save notifications in separate inserts, dropping (and logging) the ones that fail."""
+    for notification in batch:
+        try:
+            save_notifications_bulk([notification])
+        except Exception as e:
+            logger.error("Dropping notification for %s: %s", notification["resource"], e)
+
+
+async def _save_notification_batch(batch: list) -> None:
+    """
+    Save a batch of notifications.
+    
+    Database errors that can clear up (a locked or busy database) are retried
+    with backoff, up to SAVE_MAX_ATTEMPTS. After any other error, or once the
+    attempts run out, the notifications are saved one at a time so a bad one
+    doesn't take the rest of the batch with it.
+    """
+    delay = SAVE_RETRY_DELAY
+    for attempt in range(1, SAVE_MAX_ATTEMPTS + 1):
+        try:
+            await asyncio.to_thread(save_notifications_bulk, batch)
+            return
+        except OperationalError as e:
+            if attempt == SAVE_MAX_ATTEMPTS:
+                logger.error("Failed to save %s notifications after %s attempts: %s", len(batch), attempt, e)
+                break
+            logger.error("Failed to save %s notifications, retrying in %ss: %s", len(batch), delay, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SAVE_RETRY_MAX_DELAY)
+        except Exception as e:
+            logger.error("Failed to save %s notifications: %s", len(batch), e)
+            break
+    await asyncio.to_thread(_save_notifications_one_by_one, batch)
+
+
+async def _drain_notification_queue(queue: asyncio.Queue) -> None:
+    """
+    Write queued webhook batches to the database.
+    
+    Batches that piled up while the previous insert ran are merged into one
+    insert, up to SAVE_BATCH_MAX notifications. A batch that can't be saved
+    yet is retried; if the task is cancelled meanwhile, it goes back on the
+    queue for the shutdown flush.
+    """
+    while True:
+        batch = await queue.get()
+        taken = 1
+        while len(batch) < SAVE_BATCH_MAX and not queue.empty():
+            batch.extend(queue.get_nowait())
+            taken += 1
+        try:
+            await _save_notification_batch(batch)
+            notify_new_work()
+        except asyncio.CancelledError:
+            # Stopped mid-save on shutdown: leave the batch for the final flush
+            try:
+                queue.put_nowait(batch)
+            except asyncio.QueueFull:
+                logger.error("Notification queue full, dropping %s notifications", len(batch))
+            raise
+        finally:
+            for _ in range(taken):
+                queue.task_done()
+
+
+async def _flush_notification_queue(queue: asyncio.Queue) -> None:
+    """Save whatever is still queued in one insert (used once the saver task has stopped)."""
+    remaining = []
+    while not queue.empty():
+        remaining.extend(queue.get_nowait())
+    if not remaining:
+        return
+    try:
+        await asyncio.to_thread(save_notifications_bulk, remaining)
+        logger.info("Saved %s queued notifications on shutdown", len(remaining))
+    except Exception as e:
+        logger.error("Failed to save %s queued notifications on shutdown, saving them one at a time: %s",
+                     len(remaining), e)
+        await asyncio.to_thread(_save_notifications_one_by_one, remaining)
 
 
 @asynccontextmanager
@@ -72,15 +153,18 @@ async def lifespan(app: FastAPI):
     Lifespan context manager for FastAPI startup and shutdown.
     """
     # Startup
-    global settings, oauth_handler
-    settings = Settings()
+    global settings, oauth_handler, notification_url, client_state_key, notification_queue, _save_task
+    settings = get_settings()
+    notification_url = f"{settings.ngrok_url.rstrip('/')}/graph-webhook"
+    client_state_key = settings.client_state_secret.encode("utf-8")
     
     # Initialize OAuth handler
     oauth_handler = OAuthHandler(
         tenant_id=settings.tenant_id,
         client_id=settings.client_id,
         client_secret=settings.client_secret,
-        redirect_uri=settings.oauth_redirect_uri
+        redirect_uri=settings.oauth_redirect_uri,
+        store=create_session_store(settings.session_store_url)
     )
     
     setup_logging(settings.log_level)
@@ -90,12 +174,17 @@ async def lifespan(app: FastAPI):
     init_db(settings.db_path)
     logger.info("Database initialized")
     
+    # Start the task that saves queued webhook notifications
+    notification_queue = asyncio.Queue(maxsize=NOTIFICATION_QUEUE_SIZE)
+    _save_task = asyncio.create_task(_drain_notification_queue(notification_queue))
+    
     # Start background worker
     await start_worker(
         settings.tenant_id,
         settings.client_id,
         settings.client_secret,
-        oauth_handler=oauth_handler
+        oauth_handler=oauth_handler,
+        concurrency=settings.worker_concurrency
     )
     logger.info("Background worker started")
     
@@ -103,7 +192,15 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     logger.info("Shutting down application")
+    try:
+        await asyncio.wait_for(notification_queue.join(), timeout=SHUTDOWN_SAVE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Notification queue not drained, %s batches left", notification_queue.qsize())
+    _save_task.cancel()
+    await asyncio.gather(_save_task, return_exceptions=True)
+    await _flush_notification_queue(notification_queue)
     await stop_worker()
+    await close_http_clients()
 
 
 # Create FastAPI app
@@ -111,18 +208,36 @@ app = FastAPI(
     title="Teams Message OAuth Client",
     description="OAuth 2.0 app to fetch Teams messages. Users sign in and grant permission - no admin consent needed.",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 # Mount frontend UI
 app.mount("/ui", StaticFiles(directory="app/static", html=True), name="ui")
 
-# Add CORS middleware
+
+
+def _cors_origins(settings: Settings) -> list:
+    """Origins allowed to call the API with credentials: the app's own public URLs."""
+    redirect = urlsplit(settings.oauth_redirect_uri)
+    return sorted({settings.ngrok_url.rstrip("/"), f"{redirect.scheme}://{redirect.netloc}"})
+
+
+class _SettingsCORSMiddleware(CORSMiddleware):
+    """CORS middleware that reads its allowed origins from settings when the app starts."""
+    
+    def __init__(self, app, **kwargs):
+        # Starlette builds middleware on the first ASGI call (the lifespan
+        # startup), so importing this module doesn't need the full settings
+        super().__init__(app, allow_origins=_cors_origins(get_settings()), **kwargs)
+
+
+# Add CORS middleware (middleware must be registered before startup; the
+# origins are filled in when it is built)
 app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
+    _SettingsCORSMiddleware,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "DELETE"],
+    allow_headers=["authorization", "content-type"],
 )
 
 
@@ -146,73 +261,99 @@ async def health():
 
 # ============= Webhook Endpoint =============
 
+@app.get("/graph-webhook")
+async def graph_webhook_validation(validation_token: str = Query(..., alias="validationToken")):
+    """Echo the validation token for handshakes sent as GET."""
+    logger.info("Webhook validation request received")
+    return PlainTextResponse(content=validation_token, status_code=200)
+
+
 @app.post("/graph-webhook")
 async def graph_webhook(request: Request):
     """
     Receive Microsoft Graph change notifications.
     Handles both validation and actual notifications.
     """
-    # Handle validation request (GET with validationToken)
+    # Handle validation request (POST with validationToken), before any body work
     validation_token = request.query_params.get("validationToken")
     if validation_token:
-        logger.info(f"Webhook validation request received")
+        logger.info("Webhook validation request received")
         return PlainTextResponse(content=validation_token, status_code=200)
     
     # Handle notification POST
     try:
-        body = await request.json()
-        logger.info(f"Webhook notification received")
+        raw_body = await request.body()
+        logger.info("Webhook notification received")
         
-        # Parse notifications
         try:
-            notification_collection = NotificationCollection(**body)
-        except ValidationError as e:
-            logger.error(f"Invalid notification format: {e}")
+            body = orjson.loads(raw_body)
+        except orjson.JSONDecodeError:
+            logger.error("Invalid JSON in webhook request")
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid JSON"
+            )
+        
+        notifications = body.get("value", []) if isinstance(body, dict) else None
+        if not isinstance(notifications, list):
+            logger.error("Invalid notification format: %s", type(body).__name__)
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Invalid notification format"
             )
         
-        # Process each notification
-        for notification in notification_collection.value:
+        # Check client state before building models, then queue the batch for saving
+        pending = []
+        for item in notifications:
             # Validate client state
-            if not validate_client_state(
-                notification.client_state,
-                settings.client_state_secret
-            ):
-                logger.warning(f"Invalid client state in notification")
+            client_state = item.get("clientState") if isinstance(item, dict) else None
+            if not isinstance(client_state, str) or not validate_client_state(client_state, client_state_key):
+                logger.warning("Invalid client state in notification")
+                continue
+            subscription_id = item.get("subscriptionId")
+            resource = item.get("resource")
+            if not (subscription_id and isinstance(subscription_id, str) and resource and isinstance(resource, str)):
+                logger.warning("Notification missing subscriptionId or resource, skipping")
                 continue
             
+            # The client state proves the payload came from our subscription,
+            # and the only fields read from it are checked above, so skip
+            # pydantic validation for it
+            notification = GraphNotification.model_construct(**item)
+            
             # Look up creator from mapping
             creator_id = subscription_creators.get(notification.subscription_id)
             if creator_id:
-                logger.info(f"Found creator {creator_id} for subscription {notification.subscription_id}")
+                logger.info("Found creator %s for subscription %s", creator_id, notification.subscription_id)
             else:
-                logger.warning(f"No creator found for subscription {notification.subscription_id}, will use app token")
-            
-            # Save notification to database for processing
-            notification_id = save_notification(
-                subscription_id=notification.subscription_id,
-                resource=notification.resource,
-                payload=notification.model_dump(),
-                creator_id=creator_id
-            )
+                logger.warning("No creator found for subscription %s, will use app token", notification.subscription_id)
             
-            logger.info(
-                f"Saved notification {notification_id} for "
-                f"subscription {notification.subscription_id}"
-            )
+            # The payload stays the decoded Graph dict; it is serialized once,
+            # in save_notifications_bulk on the saver thread
+            pending.append({
+                "subscription_id": notification.subscription_id,
+                "resource": notification.resource,
+                "payload": item,
+                "creator_id": creator_id
+            })
+        
+        if pending:
+            try:
+                notification_queue.put_nowait(pending)
+            except asyncio.QueueFull:
+                # Graph redelivers on 5xx, so shed load instead of blocking the response
+                logger.error("Notification queue full, rejecting %s notifications", len(pending))
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Notification queue full"
+                )
         
-        return {"status": "accepted"}
+        return ORJSONResponse({"status": "accepted"}, status_code=status.HTTP_202_ACCEPTED)
         
-    except JSONDecodeError:
-        logger.error("Invalid JSON in webhook request")
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid JSON"
-        )
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Webhook processing error: {e}")
+        logger.error("Webhook processing error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Webhook processing failed"
@@ -221,6 +362,11 @@ async def graph_webhook(request: Request):
 
 # ============= OAuth & User Data Endpoints =============
 
+def _sign_state(state: str) -> str:
+    """Sign an OAuth state value with the client state secret (HMAC-SHA256, hex)."""
+    return hmac.digest(client_state_key, state.encode("utf-8"), "sha256").hex()
+
+
 @app.get("/auth/login")
 async def auth_login():
     """
@@ -232,11 +378,7 @@ async def auth_login():
     auth_url, state = oauth_handler.get_authorization_url()
     # Set signed state cookie to avoid losing in-memory state across instances
     response = RedirectResponse(url=auth_url)
-    sig = hmac.new(
-        settings.client_state_secret.encode("utf-8"),
-        state.encode("utf-8"),
-        hashlib.sha256
-    ).hexdigest()
+    sig = _sign_state(state)
     response.set_cookie(
         key="oauth_state",
         value=state,
@@ -253,7 +395,7 @@ async def auth_login():
         httponly=True,
         samesite="lax"
     )
-    logger.info(f"OAuth login initiated")
+    logger.info("OAuth login initiated")
     return response
 
 
@@ -266,7 +408,7 @@ async def auth_callback(request: Request, code: Optional[str] = None, state: Opt
     """
     try:
         if error:
-            logger.error(f"OAuth error: {error}")
+            logger.error("OAuth error: %s", error)
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"OAuth error: {error}"
@@ -282,28 +424,31 @@ async def auth_callback(request: Request, code: Optional[str] = None, state: Opt
         if not settings.disable_oauth_state_validation:
             stored_state = request.cookies.get("oauth_state")
             stored_sig = request.cookies.get("oauth_state_sig")
-            if not stored_state or stored_state != state:
-                logger.warning(f"Invalid state token: {state}")
+            if not stored_state or not hmac.compare_digest(stored_state.encode("utf-8"), state.encode("utf-8")):
+                logger.warning("Invalid state token: %s", state)
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail="Invalid state token"
                 )
-            expected_sig = hmac.new(
-                settings.client_state_secret.encode("utf-8"),
-                stored_state.encode("utf-8"),
-                hashlib.sha256
-            ).hexdigest()
-            if stored_sig != expected_sig:
+            expected_sig = _sign_state(stored_state)
+            if not stored_sig or not hmac.compare_digest(stored_sig.encode("utf-8"), expected_sig.encode("utf-8")):
                 logger.warning("Invalid state signature")
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail="Invalid state token"
                 )
+            if state in _used_oauth_states:
+                logger.warning("OAuth state replayed: %s", state)
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Invalid state token"
+                )
+            _used_oauth_states[state] = True
         else:
             logger.warning("OAuth state validation disabled via configuration. Enable for production.")
         
         # Exchange code for token
-        session = oauth_handler.exchange_code_for_token(code)
+        session = await asyncio.to_thread(oauth_handler.exchange_code_for_token, code)
         
         if not session:
             raise HTTPException(
@@ -311,7 +456,7 @@ async def auth_callback(request: Request, code: Optional[str] = None, state: Opt
                 detail="Failed to exchange code for token"
             )
         
-        logger.info(f"User authenticated: {session.user_email}")
+        logger.info("User authenticated: %s", session.user_email)
         
         # Redirect to UI with user_id for convenience
         resp = RedirectResponse(url=f"/ui?user_id={session.user_id}")
@@ -329,7 +474,7 @@ async def auth_callback(request: Request, code: Optional[str] = None, state: Opt
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"OAuth callback error: {e}")
+        logger.error("OAuth callback error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Authentication failed"
@@ -345,10 +490,11 @@ async def auth_logout(user_id: str):
     - user_id: The user's Microsoft ID (from login callback)
     """
     try:
-        oauth_handler.logout(user_id)
+        # The session store may be Redis or Memcached, so keep its I/O off the loop
+        await asyncio.to_thread(oauth_handler.logout, user_id)
         return {"status": "logged_out", "user_id": user_id}
     except Exception as e:
-        logger.error(f"Logout error: {e}")
+        logger.error("Logout error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Logout failed"
@@ -357,6 +503,69 @@ async def auth_logout(user_id: str):
 
 # ============= User Messages Endpoint (OAuth) =============
 
+# Concurrent per-chat message requests in _recent_chat_messages
+CHAT_FETCH_CONCURRENCY = 5
+
+
+async def _user_graph_client(user_id: str) -> GraphClient:
+    """
+    Get a Graph client that acts with the user's delegated token.
+    
+    Raises:
+        HTTPException: 401 if the user has no session or no valid token
+    """
+    # A token cache miss reads the session store (possibly Redis or Memcached)
+    # and may refresh the token over HTTP, so both calls run in a thread
+    client = await asyncio.to_thread(oauth_handler.get_graph_client, user_id)
+    if not client:
+        if not await asyncio.to_thread(oauth_handler.get_session, user_id):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="User not authenticated. Call /auth/login first."
+            )
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token expired or unavailable. Please login again."
+        )
+    return client
+
+
+async def _recent_chat_messages(client: GraphClient, limit: int) -> list:
+    """
+    Fetch recent messages from the user's chats.
+    
+    Reads up to 5 messages from each of the first 10 chats (to avoid
+    timeouts), with up to CHAT_FETCH_CONCURRENCY requests in flight. Results
+    are taken in chat order; once they reach the limit, fetches for the
+    remaining chats are cancelled. Chats that fail are skipped.
+    """
+    chats_response = await client._make_request_async("GET", "/me/chats", params={"$top": 50})
+    chat_ids = [chat["id"] for chat in parse_json(chats_response).get("value", [])[:10] if chat.get("id")]
+    
+    semaphore = asyncio.Semaphore(CHAT_FETCH_CONCURRENCY)
+    
+    async def fetch(chat_id: str) -> list:
+        async with semaphore:
+            return await client.get_chat_messages_async(chat_id, top=5)
+    
+    tasks = [asyncio.create_task(fetch(chat_id)) for chat_id in chat_ids]
+    messages = []
+    try:
+        for chat_id, task in zip(chat_ids, tasks):
+            try:
+                messages.extend(await task)
+            except Exception as e:
+                logger.warning("Failed to fetch messages from chat %s: %s", chat_id, e)
+                continue
+            if len(messages) >= limit:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return messages[:limit]
+
+
 @app.get("/api/user/messages")
 async def get_user_messages(user_id: str, team_id: Optional[str] = None, channel_id: Optional[str] = None, limit: int = 50):
     """
@@ -373,71 +582,34 @@ async def get_user_messages(user_id: str, team_id: Optional[str] = None, channel
     - Get channel messages: /api/user/messages?user_id=USER_ID&team_id=TEAM_ID&channel_id=CHANNEL_ID&limit=10
     """
     try:
-        if limit > 500:
-            limit = 500
+        limit = min(limit, 500)
         
-        session = oauth_handler.get_session(user_id)
-        if not session:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="User not authenticated. Call /auth/login first."
-            )
-        
-        token = oauth_handler.get_valid_token(user_id)
-        if not token:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token expired or unavailable. Please login again."
-            )
-        
-        client = GraphClient(
-            settings.tenant_id,
-            settings.client_id,
-            settings.client_secret,
-            user_token=token
-        )
+        client = await _user_graph_client(user_id)
         
         # Build Graph API endpoint
         if team_id and channel_id:
             # Specific channel messages
-            endpoint = f"/teams/{team_id}/channels/{channel_id}/messages?$top={limit}"
-            logger.info(f"Fetching channel messages for user {user_id}: team={team_id}, channel={channel_id}")
-            response = client._make_request("GET", endpoint)
-            messages = response.json().get("value", [])
+            endpoint = f"/teams/{team_id}/channels/{channel_id}/messages"
+            logger.info("Fetching channel messages for user %s: team=%s, channel=%s", user_id, team_id, channel_id)
+            response = await client._make_request_async("GET", endpoint, params={"$top": limit})
+            messages = parse_json(response).get("value", [])
         else:
             # Get all user's chats first, then fetch messages from each
-            logger.info(f"Fetching chats for user {user_id}")
-            chats_response = client._make_request("GET", "/me/chats?$top=50")
-            chats = chats_response.json().get("value", [])
-            
-            # Fetch messages from each chat
-            messages = []
-            for chat in chats[:min(10, len(chats))]:  # Limit to first 10 chats to avoid timeout
-                chat_id = chat.get("id")
-                if chat_id:
-                    try:
-                        msg_response = client._make_request("GET", f"/me/chats/{chat_id}/messages?$top=5")
-                        chat_messages = msg_response.json().get("value", [])
-                        messages.extend(chat_messages)
-                        if len(messages) >= limit:
-                            break
-                    except Exception as e:
-                        logger.warning(f"Failed to fetch messages from chat {chat_id}: {e}")
-                        continue
-            
-            messages = messages[:limit]
+            logger.info("Fetching chats for user %s", user_id)
+            messages = await _recent_chat_messages(client, limit)
         
-        logger.info(f"Retrieved {len(messages)} messages for user: {user_id}")
+        logger.info("Retrieved %s messages for user: %s", len(messages), user_id)
         
-        return {
+        # Returned as a Response so FastAPI skips its jsonable_encoder pass over every message
+        return ORJSONResponse({
             "count": len(messages),
             "messages": messages
-        }
+        })
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Failed to retrieve messages: {e}")
+        logger.error("Failed to retrieve messages: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to retrieve messages: {str(e)}"
@@ -450,84 +622,95 @@ async def get_user_messages(user_id: str, team_id: Optional[str] = None, channel
 async def ingest_user_messages(user_id: str, team_id: Optional[str] = None, channel_id: Optional[str] = None, limit: int = 50):
     """
     Fetch user's messages (delegated) and store normalized messages in the DB.
-    Uses same logic as /api/user/messages but persists via save_message.
+    Uses same logic as /api/user/messages but persists via save_messages_bulk.
     """
     try:
-        if limit > 500:
-            limit = 500
+        limit = min(limit, 500)
 
-        session_obj = oauth_handler.get_session(user_id)
-        if not session_obj:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="User not authenticated. Call /auth/login first."
-            )
-
-        token = oauth_handler.get_valid_token(user_id)
-        if not token:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token expired or unavailable. Please login again."
-            )
-
-        client = GraphClient(
-            settings.tenant_id,
-            settings.client_id,
-            settings.client_secret,
-            user_token=token
-        )
+        client = await _user_graph_client(user_id)
 
         fetched = []
         if team_id and channel_id:
-            endpoint = f"/teams/{team_id}/channels/{channel_id}/messages?$top={limit}"
-            logger.info(f"Ingesting channel messages for user {user_id}: team={team_id}, channel={channel_id}")
-            response = client._make_request("GET", endpoint)
-            fetched = response.json().get("value", [])
+            endpoint = f"/teams/{team_id}/channels/{channel_id}/messages"
+            logger.info("Ingesting channel messages for user %s: team=%s, channel=%s", user_id, team_id, channel_id)
+            response = await client._make_request_async("GET", endpoint, params={"$top": limit})
+            fetched = parse_json(response).get("value", [])
         else:
-            logger.info(f"Ingesting chats for user {user_id}")
-            chats_response = client._make_request("GET", "/me/chats?$top=50")
-            chats = chats_response.json().get("value", [])
-            messages = []
-            for chat in chats[:min(10, len(chats))]:
-                chat_id = chat.get("id")
-                if chat_id:
-                    try:
-                        msg_response = client._make_request("GET", f"/me/chats/{chat_id}/messages?$top=5")
-                        chat_messages = msg_response.json().get("value", [])
-                        messages.extend(chat_messages)
-                        if len(messages) >= limit:
-                            break
-                    except Exception as e:
-                        logger.warning(f"Failed to fetch messages from chat {chat_id}: {e}")
-                        continue
-            fetched = messages[:limit]
-
-        # Normalize and store
-        stored = 0
+            logger.info("Ingesting chats for user %s", user_id)
+            fetched = await _recent_chat_messages(client, limit)
+
+        # Normalize, then store everything in one transaction (raw payload in raw_json only)
+        rows = []
         for msg in fetched:
             try:
                 normalized = normalize_message(msg)
-                save_message(
-                    message_id=normalized.message_id,
-                    normalized_data=normalized.model_dump(mode='json'),
-                    raw_data=msg
-                )
-                stored += 1
+                rows.append((normalized.message_id, normalized.model_dump_json(exclude={'raw_json'}), msg))
             except Exception as e:
-                logger.warning(f"Failed to normalize/store message: {e}")
+                logger.warning("Failed to normalize message: %s", e)
+        await asyncio.to_thread(save_messages_bulk, rows)
+        stored = len(rows)
 
-        logger.info(f"Stored {stored} messages for user {user_id}")
+        logger.info("Stored %s messages for user %s", stored, user_id)
         return {"stored": stored}
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Failed to ingest messages: {e}")
+        logger.error("Failed to ingest messages: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to ingest messages: {str(e)}"
         )
 
 
+# Rows per chunk when streaming GET /messages
+STREAM_CHUNK_ROWS = 100
+
+# Built once at import; selecting columns skips ORM object hydration per row
+_RECENT_MESSAGES_QUERY = (
+    select(Message.id, Message.message_id, Message.normalized_json, Message.raw_json, Message.ingested_at)
+    .order_by(Message.ingested_at.desc())
+    .limit(bindparam("limit"))
+)
+
+
+def _message_json(row_id: int, message_id: str, normalized_json: str, raw_json: str,
+                  ingested_at: Optional[datetime]) -> bytes:
+    """
+    Build the JSON for a stored message without re-parsing its JSON columns.
+    
+    The columns hold orjson output (see storage._insert_messages), so they are spliced in as-is.
+    """
+    return b'{"id":%d,"message_id":%b,"normalized_json":%b,"raw_json":%b,"ingested_at":%b}' % (
+        row_id,
+        orjson.dumps(message_id),
+        normalized_json.encode("utf-8"),
+        raw_json.encode("utf-8"),
+        orjson.dumps(ingested_at.isoformat() if ingested_at else None),
+    )
+
+
+def _stream_recent_messages(limit: int) -> Iterator[bytes]:
+    """
+    Yield the GET /messages JSON body straight from the database cursor.
+    
+    Rows are emitted in chunks of STREAM_CHUNK_ROWS; Starlette iterates this
+    generator in a worker thread, so the blocking reads stay off the event loop.
+    The count is only known at the end, so it is written after the messages.
+    """
+    count = 0
+    yield b'{"messages":['
+    with get_db().get_read_session() as session:
+        result = session.execute(
+            _RECENT_MESSAGES_QUERY.execution_options(stream_results=True), {"limit": limit}
+        )
+        for rows in result.partitions(STREAM_CHUNK_ROWS):
+            chunk = b",".join(_message_json(*row) for row in rows)
+            yield b"," + chunk if count else chunk
+            count += len(rows)
+    logger.info("Retrieved %s messages", count)
+    yield b'],"count":%d}' % count
+
+
 @app.get("/messages")
 async def get_all_messages(limit: int = 50):
     """
@@ -537,39 +720,12 @@ async def get_all_messages(limit: int = 50):
     
     Query Parameters:
     - limit: Maximum number of messages to return (default: 50, max: 500)
-    """
-    try:
-        if limit > 500:
-            limit = 500
-        
-        db = get_db()
-        with db.get_session() as session:
-            messages = session.query(Message).order_by(
-                Message.ingested_at.desc()
-            ).limit(limit).all()
-            
-            result = []
-            for msg in messages:
-                result.append({
-                    "id": msg.id,
-                    "message_id": msg.message_id,
-                    "normalized_json": json.loads(msg.normalized_json),
-                    "raw_json": json.loads(msg.raw_json),
-                    "ingested_at": msg.ingested_at.isoformat() if msg.ingested_at else None
-                })
-            
-            logger.info(f"Retrieved {len(result)} messages")
-            return {
-                "count": len(result),
-                "messages": result
-            }
     
-    except Exception as e:
-        logger.error(f"Failed to retrieve messages: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to retrieve messages: {str(e)}"
-        )
+    The body is streamed, so a database error after the first chunk aborts
+    the response instead of returning a 500.
+    """
+    limit = min(limit, 500)
+    return StreamingResponse(_stream_recent_messages(limit), media_type="application/json")
 
 
 @app.get("/messages/{message_id}")
@@ -581,7 +737,7 @@ async def get_message(message_id: str):
     - message_id: The Teams message ID
     """
     try:
-        message = get_message_by_id(message_id)
+        message = await asyncio.to_thread(get_message_by_id, message_id)
         
         if not message:
             raise HTTPException(
@@ -589,18 +745,15 @@ async def get_message(message_id: str):
                 detail=f"Message {message_id} not found"
             )
         
-        return {
-            "id": message.id,
-            "message_id": message.message_id,
-            "normalized_json": json.loads(message.normalized_json),
-            "raw_json": json.loads(message.raw_json),
-            "ingested_at": message.ingested_at.isoformat() if message.ingested_at else None
-        }
+        body = _message_json(
+            message.id, message.message_id, message.normalized_json, message.raw_json, message.ingested_at
+        )
+        return Response(content=body, media_type="application/json")
     
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Failed to retrieve message: {e}")
+        logger.error("Failed to retrieve message: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to retrieve message: {str(e)}"
@@ -612,8 +765,8 @@ async def get_message(message_id: str):
 @app.post("/subscriptions")
 async def create_subscription_api(req: SubscriptionCreateRequest):
     try:
-        notification_url = f"{settings.ngrok_url.rstrip('/')}/graph-webhook"
-        sub = create_teams_subscription(
+        sub = await asyncio.to_thread(
+            create_teams_subscription,
             tenant_id=settings.tenant_id,
             client_id=settings.client_id,
             client_secret=settings.client_secret,
@@ -622,30 +775,32 @@ async def create_subscription_api(req: SubscriptionCreateRequest):
             client_state=settings.client_state_secret,
             expiration_hours=req.expiration_hours,
         )
-        return sub
+        return ORJSONResponse(sub)
     except Exception as e:
-        logger.error(f"Create subscription failed: {e}")
+        logger.error("Create subscription failed: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.get("/subscriptions")
 async def list_subscriptions_api():
     try:
-        subs = list_subscriptions(
+        subs = await asyncio.to_thread(
+            list_subscriptions,
             tenant_id=settings.tenant_id,
             client_id=settings.client_id,
             client_secret=settings.client_secret,
         )
-        return {"subscriptions": subs, "count": len(subs)}
+        return ORJSONResponse({"subscriptions": subs, "count": len(subs)})
     except Exception as e:
-        logger.error(f"List subscriptions failed: {e}")
+        logger.error("List subscriptions failed: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.delete("/subscriptions/{subscription_id}")
 async def delete_subscription_api(subscription_id: str):
     try:
-        delete_subscription_fn(
+        await asyncio.to_thread(
+            delete_subscription_fn,
             tenant_id=settings.tenant_id,
             client_id=settings.client_id,
             client_secret=settings.client_secret,
@@ -655,11 +810,11 @@ async def delete_subscription_api(subscription_id: str):
         # Remove from creator mapping
         if subscription_id in subscription_creators:
             del subscription_creators[subscription_id]
-            logger.info(f"Removed creator mapping for subscription {subscription_id}")
+            logger.info("Removed creator mapping for subscription %s", subscription_id)
         
         return {"message": "Subscription deleted successfully"}
     except Exception as e:
-        logger.error(f"Delete subscription failed: {e}")
+        logger.error("Delete subscription failed: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -672,21 +827,15 @@ async def clear_failed_notifications():
     Example: POST /api/admin/clear-failed-notifications
     """
     try:
-        db = get_db()
-        with db.get_session() as session:
-            from app.storage import Notification
-            deleted = session.query(Notification).filter(
-                Notification.status.in_(["failed", "processing", "pending"])
-            ).delete()
-            session.commit()
-            logger.info(f"Cleared {deleted} failed/processing/pending notifications")
-            return {
-                "status": "cleared",
-                "deleted_count": deleted,
-                "message": "Old notifications cleared. Ready for new subscriptions."
-            }
+        deleted = await asyncio.to_thread(delete_notifications, ["failed", "processing", "pending"])
+        logger.info("Cleared %s failed/processing/pending notifications", deleted)
+        return {
+            "status": "cleared",
+            "deleted_count": deleted,
+            "message": "Old notifications cleared. Ready for new subscriptions."
+        }
     except Exception as e:
-        logger.error(f"Failed to clear notifications: {e}")
+        logger.error("Failed to clear notifications: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to clear notifications: {str(e)}"
@@ -716,37 +865,16 @@ async def create_user_subscription(
     POST /api/user/subscriptions?user_id=USER_ID&team_id=TEAM_ID&channel_id=CHANNEL_ID
     """
     try:
-        # Get user's session
-        session_obj = oauth_handler.get_session(user_id)
-        if not session_obj:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="User not authenticated. Call /auth/login first."
-            )
-        
-        # Get valid delegated token
-        token = oauth_handler.get_valid_token(user_id)
-        if not token:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token expired. Please login again."
-            )
-        
-        # Create Graph client with USER's token (delegated)
-        client = GraphClient(
-            settings.tenant_id,
-            settings.client_id,
-            settings.client_secret,
-            user_token=token
-        )
+        # Graph client with USER's token (delegated)
+        client = await _user_graph_client(user_id)
         
         # Build resource path
         resource = f"/teams/{team_id}/channels/{channel_id}/messages"
-        notification_url = f"{settings.ngrok_url.rstrip('/')}/graph-webhook"
         
         # Create subscription with delegated permissions
-        logger.info(f"Creating delegated subscription for user {user_id}: {resource}")
-        subscription = client.create_subscription(
+        logger.info("Creating delegated subscription for user %s: %s", user_id, resource)
+        subscription = await asyncio.to_thread(
+            client.create_subscription,
             resource=resource,
             notification_url=notification_url,
             client_state=settings.client_state_secret,
@@ -757,9 +885,9 @@ async def create_user_subscription(
         subscription_id = subscription.get('id')
         if subscription_id:
             subscription_creators[subscription_id] = user_id
-            logger.info(f"Stored creator mapping: subscription {subscription_id} -> user {user_id}")
+            logger.info("Stored creator mapping: subscription %s -> user %s", subscription_id, user_id)
         
-        logger.info(f"Delegated subscription created: {subscription_id}")
+        logger.info("Delegated subscription created: %s", subscription_id)
         return {
             "status": "success",
             "message": "Subscription created with your delegated permissions",
@@ -769,7 +897,7 @@ async def create_user_subscription(
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Failed to create delegated subscription: {e}")
+        logger.error("Failed to create delegated subscription: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to create subscription: {str(e)}"
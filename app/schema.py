@@ -3,8 +3,10 @@ Pydantic models for normalized Teams messages and validation.
 """
 
 from datetime import datetime
+from functools import lru_cache
+from html import unescape
 from typing import Optional, List, Dict, Any
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
 import re
 import logging
 
@@ -28,6 +30,10 @@ class Attachment(BaseModel):
     name: Optional[str] = None
 
 
+_MENTION_LIST = TypeAdapter(List[Mention])
+_ATTACHMENT_LIST = TypeAdapter(List[Attachment])
+
+
 class NormalizedMessage(BaseModel):
     """Normalized Teams message schema."""
     
@@ -59,6 +65,12 @@ class NormalizedMessage(BaseModel):
         }
 
 
+_TAG_RE = re.compile(r'<[^>]+>')
+# Team and channel IDs in a message webUrl
+_GROUP_ID_RE = re.compile(r'groupId=([^&]+)')
+_CHANNEL_RE = re.compile(r'/l/message/([^/]+)/')
+
+
 def strip_html(html_content: str) -> str:
     """
     Strip HTML tags from content.
@@ -73,20 +85,30 @@ def strip_html(html_content: str) -> str:
         return ""
     
     # Remove HTML tags
-    text = re.sub(r'<[^>]+>', '', html_content)
-    
-    # Decode common HTML entities
-    text = text.replace('&nbsp;', ' ')
-    text = text.replace('&lt;', '<')
-    text = text.replace('&gt;', '>')
-    text = text.replace('&amp;', '&')
-    text = text.replace('&quot;', '"')
-    text = text.replace('&#39;', "'")
+    text = _TAG_RE.sub('', html_content)
     
-    # Clean up whitespace
-    text = re.sub(r'\s+', ' ', text).strip()
+    # Decode HTML entities, including numeric ones like &#8217; (returns
+    # immediately when there is no '&', as in most message bodies)
+    text = unescape(text)
     
-    return text
+    # Collapse and trim whitespace (&nbsp; decodes to U+00A0, which counts
+    # as whitespace here, as it does for \s)
+    return ' '.join(text.split())
+
+
+@lru_cache(maxsize=4096)
+def _parse_datetime(value: str) -> datetime:
+    """Parse a Graph ISO 8601 timestamp; cached since reprocessed messages repeat them."""
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _dig(data: Optional[Dict[str, Any]], *keys: str) -> Any:
+    """Follow nested keys, returning None as soon as one is missing or null."""
+    for key in keys:
+        if data is None:
+            return None
+        data = data.get(key)
+    return data
 
 
 def normalize_message(graph_message: Dict[str, Any]) -> NormalizedMessage:
@@ -113,9 +135,7 @@ def normalize_message(graph_message: Dict[str, Any]) -> NormalizedMessage:
             raise ValueError("Created datetime is required")
         
         # Parse datetime
-        created_datetime = datetime.fromisoformat(
-            created_datetime_str.replace("Z", "+00:00")
-        )
+        created_datetime = _parse_datetime(created_datetime_str)
         
         # Extract IDs from webUrl or other fields
         team_id = None
@@ -125,48 +145,40 @@ def normalize_message(graph_message: Dict[str, Any]) -> NormalizedMessage:
         if web_url:
             # Parse team and channel IDs from webUrl
             # Format: https://teams.microsoft.com/l/message/{channel-id}/...?groupId={team-id}
-            team_match = re.search(r'groupId=([^&]+)', web_url)
+            team_match = _GROUP_ID_RE.search(web_url)
             if team_match:
                 team_id = team_match.group(1)
             
-            channel_match = re.search(r'/l/message/([^/]+)/', web_url)
+            channel_match = _CHANNEL_RE.search(web_url)
             if channel_match:
                 channel_id = channel_match.group(1).split('@')[0]
         
-        # Extract sender info
-        sender = graph_message.get("from", {})
-        sender_user = sender.get("user", {})
-        sender_id = sender_user.get("id")
-        sender_name = sender_user.get("displayName")
+        # Extract sender info (Graph sends "from": null for system messages)
+        sender_id = _dig(graph_message, "from", "user", "id")
+        sender_name = _dig(graph_message, "from", "user", "displayName")
         
         # Extract and clean body text
-        body = graph_message.get("body", {})
-        body_content = body.get("content", "")
-        body_text = strip_html(body_content)
+        body_text = strip_html(_dig(graph_message, "body", "content"))
         
-        # Extract mentions
-        mentions = []
-        mentions_data = graph_message.get("mentions", [])
-        for mention_data in mentions_data:
-            mentioned = mention_data.get("mentioned", {})
-            mention = Mention(
-                user_id=mentioned.get("user", {}).get("id"),
-                display_name=mentioned.get("user", {}).get("displayName"),
-                mentioned_text=mention_data.get("mentionText")
-            )
-            mentions.append(mention)
+        # Extract mentions and attachments, validating each list in one call
+        mentions = _MENTION_LIST.validate_python([
+            {
+                "user_id": _dig(mention_data, "mentioned", "user", "id"),
+                "display_name": _dig(mention_data, "mentioned", "user", "displayName"),
+                "mentioned_text": mention_data.get("mentionText")
+            }
+            for mention_data in graph_message.get("mentions") or []
+        ])
         
-        # Extract attachments
-        attachments = []
-        attachments_data = graph_message.get("attachments", [])
-        for attachment_data in attachments_data:
-            attachment = Attachment(
-                id=attachment_data.get("id"),
-                content_type=attachment_data.get("contentType"),
-                content_url=attachment_data.get("contentUrl"),
-                name=attachment_data.get("name")
-            )
-            attachments.append(attachment)
+        attachments = _ATTACHMENT_LIST.validate_python([
+            {
+                "id": attachment_data.get("id"),
+                "content_type": attachment_data.get("contentType"),
+                "content_url": attachment_data.get("contentUrl"),
+                "name": attachment_data.get("name")
+            }
+            for attachment_data in graph_message.get("attachments") or []
+        ])
         
         # Create normalized message
         normalized = NormalizedMessage(
@@ -182,11 +194,11 @@ def normalize_message(graph_message: Dict[str, Any]) -> NormalizedMessage:
             raw_json=graph_message
         )
         
-        logger.info(f"Normalized message {message_id}")
+        logger.info("Normalized message %s", message_id)
         return normalized
         
     except Exception as e:
-        logger.error(f"Failed to normalize message: {e}")
+        logger.error("Failed to normalize message: %s", e)
         raise ValueError(f"Message normalization failed: {e}")
 
 
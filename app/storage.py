@@ -4,19 +4,60 @@ Manages notifications and normalized messages.
 """
 
 from datetime import datetime
-from typing import List, Optional
-import json
+from typing import Any, Dict, List, Optional, Tuple, Union
 import logging
 
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime
+import orjson
+
+from sqlalchemy import bindparam, case, create_engine, event, insert, make_url, select, update, Column, Row, Integer, String, Text, DateTime
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
 
 logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+# Applied to every new SQLite connection: WAL lets the webhook, worker and
+# /messages readers run alongside a writer, a 64 MB page cache and 256 MB
+# memory map keep hot pages in memory between requests, and busy_timeout
+# makes concurrent writers wait for the lock instead of failing.
+# With WAL, synchronous=NORMAL skips the fsync on each commit: a crash of the
+# process loses nothing, but a power loss or OS crash can roll back the most
+# recent commits (the database itself stays consistent). Notifications in
+# those commits are lost: Graph already got its 202 and won't redeliver them.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """Configure a freshly opened SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+# A JSON column value: a dict to serialize, or JSON text that is stored as-is
+JsonValue = Union[dict, str]
+
+
+def _json_text(value: JsonValue) -> str:
+    """Serialize a dict for a JSON text column; strings are assumed to be JSON already."""
+    return value if isinstance(value, str) else orjson.dumps(value).decode()
+
+
+# Connections kept open for /messages and other read-only queries
+READ_POOL_SIZE = 8
+
 
 class Notification(Base):
     """Model for storing raw Graph notifications."""
@@ -53,24 +94,51 @@ class Database:
         """
         Initialize database connection.
         
+        File-backed SQLite gets two engines: a single-connection writer pool,
+        so writes queue in the pool instead of fighting over the SQLite lock,
+        and a reader pool that WAL lets run alongside it. Other databases
+        (and in-memory SQLite, which cannot be shared between engines) use
+        one engine for both.
+        
         Args:
             db_url: SQLAlchemy database URL
         """
-        self.engine = create_engine(db_url, echo=False)
+        url = make_url(db_url)
+        if url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:"):
+            self.engine = create_engine(
+                url, echo=False, poolclass=QueuePool, pool_size=1, max_overflow=0
+            )
+            self.read_engine = create_engine(
+                url, echo=False, poolclass=QueuePool, pool_size=READ_POOL_SIZE
+            )
+        else:
+            self.engine = create_engine(url, echo=False)
+            self.read_engine = self.engine
+        if url.get_backend_name() == "sqlite":
+            for engine in {self.engine, self.read_engine}:
+                event.listen(engine, "connect", _apply_sqlite_pragmas)
         self.SessionLocal = sessionmaker(bind=self.engine, autoflush=False, autocommit=False)
+        self.ReadSessionLocal = sessionmaker(bind=self.read_engine, autoflush=False, autocommit=False)
         try:
             Base.metadata.create_all(bind=self.engine, checkfirst=True)
         except OperationalError as e:
             # Handle race condition when multiple workers try to create tables simultaneously
             if "already exists" in str(e):
-                logger.debug(f"Tables already exist, skipping creation: {e}")
+                logger.debug("Tables already exist, skipping creation: %s", e)
             else:
                 raise
-        logger.info(f"Database initialized at {db_url}")
+        logger.info("Database initialized at %s", db_url)
     
-    def get_session(self) -> Session:
-        """Get a new database session."""
+    def get_write_session(self) -> Session:
+        """Get a new session on the writer connection."""
         return self.SessionLocal()
+    
+    def get_read_session(self) -> Session:
+        """Get a new session on the reader pool."""
+        return self.ReadSessionLocal()
+    
+    # Existing callers that both read and write go through the writer
+    get_session = get_write_session
 
 
 # Global database instance (initialized in main.py)
@@ -101,161 +169,215 @@ def get_db() -> Database:
 
 # Helper functions for notifications
 
-def save_notification(
-    subscription_id: str,
-    resource: str,
-    payload: dict,
-    creator_id: Optional[str] = None
-) -> int:
+def save_notifications_bulk(notifications: List[Dict[str, Any]]) -> List[int]:
     """
-    Save a new notification to the database.
+    Save several notifications with one INSERT and a single commit.
     
     Args:
-        subscription_id: Graph subscription ID
-        resource: Resource path from notification
-        payload: Full notification payload
-        creator_id: User ID who created the subscription (for delegated token)
+        notifications: Dicts with subscription_id, resource, payload and
+            optional creator_id; payload is a dict or already-serialized JSON
         
     Returns:
-        Notification ID
+        Notification IDs, in input order
     """
+    rows = [
+        {
+            "subscription_id": n["subscription_id"],
+            "creator_id": n.get("creator_id"),
+            "resource": n["resource"],
+            "payload_json": _json_text(n["payload"]),
+            "status": "pending",
+            "attempts": 0
+        }
+        for n in notifications
+    ]
     db = get_db()
-    with db.get_session() as session:
-        notification = Notification(
-            subscription_id=subscription_id,
-            creator_id=creator_id,
-            resource=resource,
-            payload_json=json.dumps(payload),
-            status="pending",
-            attempts=0
-        )
-        session.add(notification)
+    with db.get_write_session() as session:
+        stmt = insert(Notification).returning(Notification.id, sort_by_parameter_order=True)
+        ids = list(session.scalars(stmt, rows))
         session.commit()
-        session.refresh(notification)
-        logger.info(f"Saved notification {notification.id} for resource {resource}")
-        return notification.id
+    logger.info("Saved %s notifications", len(ids))
+    return ids
+
 
+# Attempts after which a failing notification is no longer retried
+MAX_NOTIFICATION_ATTEMPTS = 5
 
-def get_pending_notifications(limit: int = 10) -> List[Notification]:
+
+def claim_pending_notifications(limit: int = 10) -> List[Row]:
     """
-    Get pending notifications to process.
-    
+    Mark the oldest pending notifications as processing and return them.
+
+    Selecting and marking happen in one UPDATE ... RETURNING on the writer
+    connection, so two workers can never claim the same row.
+
     Args:
-        limit: Maximum number of notifications to retrieve
-        
+        limit: Maximum number of notifications to claim
+
     Returns:
-        List of pending notifications
+        Rows with id, resource and creator_id, oldest first
     """
     db = get_db()
-    with db.get_session() as session:
-        notifications = session.query(Notification).filter(
-            Notification.status == "pending"
-        ).limit(limit).all()
-        
-        # Detach from session to avoid lazy loading issues
-        session.expunge_all()
-        return notifications
+    with db.get_write_session() as session:
+        rows = session.execute(
+            update(Notification)
+            .where(Notification.id.in_(
+                select(Notification.id)
+                .where(Notification.status == "pending")
+                .order_by(Notification.id)
+                .limit(limit)
+            ))
+            .values(status="processing", attempts=Notification.attempts + 1)
+            .returning(Notification.id, Notification.resource, Notification.creator_id)
+            .execution_options(synchronize_session=False)
+        ).all()
+        session.commit()
+    # RETURNING doesn't guarantee order
+    rows.sort(key=lambda row: row.id)
+    logger.debug("Claimed %s notifications", len(rows))
+    return rows
 
 
-def mark_notification_processing(notification_id: int) -> None:
+def release_notifications(notification_ids: List[int]) -> None:
     """
-    Mark a notification as being processed.
-    
+    Return claimed notifications to pending without counting the attempt.
+
     Args:
-        notification_id: Notification ID
+        notification_ids: Notification IDs claimed but not processed
     """
+    if not notification_ids:
+        return
     db = get_db()
-    with db.get_session() as session:
-        notification = session.query(Notification).filter(
-            Notification.id == notification_id
-        ).first()
-        
-        if notification:
-            notification.status = "processing"
-            notification.attempts += 1
-            session.commit()
-            logger.debug(f"Marked notification {notification_id} as processing")
+    with db.get_write_session() as session:
+        session.execute(
+            update(Notification)
+            .where(Notification.id.in_(notification_ids), Notification.status == "processing")
+            .values(status="pending", attempts=Notification.attempts - 1)
+        )
+        session.commit()
+    logger.info("Released %s unprocessed notifications", len(notification_ids))
 
 
-def mark_notification_done(notification_id: int) -> None:
+def finalize_notification_batch(
+    messages: List[Tuple[str, JsonValue, JsonValue]],
+    done_ids: List[int],
+    failures: Dict[int, str]
+) -> None:
     """
-    Mark a notification as successfully processed.
+    Store a processed batch's messages and record its outcomes in one commit.
+    
+    Failed notifications go back to pending until they reach
+    MAX_NOTIFICATION_ATTEMPTS, then stay failed.
     
     Args:
-        notification_id: Notification ID
+        messages: (message_id, normalized_data, raw_data) tuples to store;
+            messages that already exist are skipped
+        done_ids: IDs of notifications processed successfully
+        failures: Error description per failed notification ID
     """
     db = get_db()
-    with db.get_session() as session:
-        notification = session.query(Notification).filter(
-            Notification.id == notification_id
-        ).first()
-        
-        if notification:
-            notification.status = "done"
-            session.commit()
-            logger.info(f"Marked notification {notification_id} as done")
+    with db.get_write_session() as session:
+        if messages:
+            _insert_messages(session, messages)
+        if done_ids:
+            session.execute(
+                update(Notification).where(Notification.id.in_(done_ids)).values(status="done")
+            )
+        if failures:
+            table = Notification.__table__
+            session.execute(
+                update(table)
+                .where(table.c.id == bindparam("notification_id"))
+                .values(
+                    status=case((table.c.attempts >= MAX_NOTIFICATION_ATTEMPTS, "failed"), else_="pending"),
+                    error_message=bindparam("error")
+                ),
+                [{"notification_id": i, "error": error} for i, error in failures.items()]
+            )
+        session.commit()
+    logger.info("Finalized notifications: %s done, %s failed", len(done_ids), len(failures))
+    for notification_id, error in failures.items():
+        logger.warning("Notification %s failed: %s", notification_id, error)
 
 
-def mark_notification_failed(notification_id: int, error_message: str) -> None:
+def delete_notifications(statuses: List[str]) -> int:
     """
-    Mark a notification as failed.
+    Delete notifications in any of the given statuses.
     
     Args:
-        notification_id: Notification ID
-        error_message: Error description
+        statuses: Notification statuses to delete (e.g. "failed", "pending")
+        
+    Returns:
+        Number of deleted notifications
     """
     db = get_db()
-    with db.get_session() as session:
-        notification = session.query(Notification).filter(
-            Notification.id == notification_id
-        ).first()
-        
-        if notification:
-            # If too many attempts, mark as failed, otherwise back to pending
-            if notification.attempts >= 5:
-                notification.status = "failed"
-            else:
-                notification.status = "pending"
-            notification.error_message = error_message
-            session.commit()
-            logger.warning(f"Notification {notification_id} failed: {error_message}")
+    with db.get_write_session() as session:
+        deleted = session.query(Notification).filter(
+            Notification.status.in_(statuses)
+        ).delete()
+        session.commit()
+        return deleted
 
 
 # Helper functions for messages
 
-def save_message(message_id: str, normalized_data: dict, raw_data: dict) -> int:
+def save_messages_bulk(messages: List[Tuple[str, JsonValue, JsonValue]]) -> int:
     """
-    Save a normalized message to the database.
+    Save several normalized messages in one transaction.
+    
+    Messages that are already stored are skipped, so the first copy is kept.
     
     Args:
-        message_id: Teams message ID
-        normalized_data: Normalized message data
-        raw_data: Raw Graph API response
+        messages: (message_id, normalized_data, raw_data) tuples, with data
+            as dicts or already-serialized JSON
         
     Returns:
-        Message ID
+        Number of newly inserted messages
     """
+    if not messages:
+        return 0
     db = get_db()
-    with db.get_session() as session:
-        # Check if message already exists
-        existing = session.query(Message).filter(
-            Message.message_id == message_id
-        ).first()
-        
-        if existing:
-            logger.info(f"Message {message_id} already exists, skipping")
-            return existing.id
-        
-        message = Message(
-            message_id=message_id,
-            normalized_json=json.dumps(normalized_data),
-            raw_json=json.dumps(raw_data)
-        )
-        session.add(message)
+    with db.get_write_session() as session:
+        inserted = _insert_messages(session, messages)
         session.commit()
-        session.refresh(message)
-        logger.info(f"Saved message {message_id} with ID {message.id}")
-        return message.id
+    logger.info("Saved %s new messages (%s skipped)", inserted, len(messages) - inserted)
+    return inserted
+
+
+def _insert_messages(session: Session, messages: List[Tuple[str, JsonValue, JsonValue]]) -> int:
+    """
+    Insert messages in one statement, skipping stored message IDs; returns rows inserted.
+    
+    The JSON columns are stored compact so GET /messages can splice them into
+    responses unparsed.
+    """
+    rows = [
+        {
+            "message_id": message_id,
+            "normalized_json": _json_text(normalized_data),
+            "raw_json": _json_text(raw_data)
+        }
+        for message_id, normalized_data, raw_data in messages
+    ]
+    stmt = sqlite_insert(Message.__table__).on_conflict_do_nothing(index_elements=["message_id"])
+    return session.execute(stmt, rows).rowcount
+
+
+def get_recent_message_ids(limit: int = 10000) -> List[str]:
+    """
+    Get the Teams message IDs of the most recently stored messages.
+    
+    Args:
+        limit: Maximum number of IDs to return
+        
+    Returns:
+        Message IDs, newest first
+    """
+    db = get_db()
+    with db.get_read_session() as session:
+        return list(session.execute(
+            select(Message.message_id).order_by(Message.id.desc()).limit(limit)
+        ).scalars())
 
 
 def get_message_by_id(message_id: str) -> Optional[Message]:
@@ -269,7 +391,7 @@ def get_message_by_id(message_id: str) -> Optional[Message]:
         Message object or None
     """
     db = get_db()
-    with db.get_session() as session:
+    with db.get_read_session() as session:
         message = session.query(Message).filter(
             Message.message_id == message_id
         ).first()
@@ -1,45 +1,57 @@
 """Functions for managing Microsoft Graph subscriptions."""
 
 import logging
+from functools import lru_cache
 from typing import Dict, Any
 from app.graph_client import GraphClient
 
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=8)
+def _graph_client(tenant_id: str, client_id: str, client_secret: str) -> GraphClient:
+    """Get the app-only client for these credentials, reusing its token across calls."""
+    return GraphClient(tenant_id, client_id, client_secret)
+
+
 def create_teams_subscription(tenant_id: str, client_id: str, client_secret: str,
                              resource: str, notification_url: str, client_state: str,
                              expiration_hours: int = 1) -> Dict[str, Any]:
     """Create subscription for Teams messages."""
-    logger.info(f"Creating subscription for resource: {resource}")
-    client = GraphClient(tenant_id, client_id, client_secret)
-    subscription = client.create_subscription(resource, notification_url, client_state, expiration_hours)
-    logger.info(f"Created subscription: {subscription.get('id')}")
+    logger.info("Creating subscription for resource: %s", resource)
+    client = _graph_client(tenant_id, client_id, client_secret)
+    subscription = client.create_subscription(
+        resource=resource,
+        notification_url=notification_url,
+        client_state=client_state,
+        expiration_hours=expiration_hours
+    )
+    logger.info("Created subscription: %s", subscription.get('id'))
     return subscription
 
 
 def renew_subscription(tenant_id: str, client_id: str, client_secret: str,
                       subscription_id: str, expiration_hours: int = 1) -> Dict[str, Any]:
     """Renew existing subscription."""
-    logger.info(f"Renewing subscription: {subscription_id}")
-    client = GraphClient(tenant_id, client_id, client_secret)
-    subscription = client.renew_subscription(subscription_id, expiration_hours)
-    logger.info(f"Renewed subscription: {subscription_id}")
+    logger.info("Renewing subscription: %s", subscription_id)
+    client = _graph_client(tenant_id, client_id, client_secret)
+    subscription = client.renew_subscription(subscription_id, expiration_hours=expiration_hours)
+    logger.info("Renewed subscription: %s", subscription_id)
     return subscription
 
 
 def list_subscriptions(tenant_id: str, client_id: str, client_secret: str) -> list:
     """List all active subscriptions."""
     logger.info("Listing subscriptions")
-    client = GraphClient(tenant_id, client_id, client_secret)
+    client = _graph_client(tenant_id, client_id, client_secret)
     subscriptions = client.list_subscriptions()
-    logger.info(f"Found {len(subscriptions)} subscriptions")
+    logger.info("Found %s subscriptions", len(subscriptions))
     return subscriptions
 
 
 def delete_subscription(tenant_id: str, client_id: str, client_secret: str, subscription_id: str) -> None:
     """Delete subscription."""
-    logger.info(f"Deleting subscription: {subscription_id}")
-    client = GraphClient(tenant_id, client_id, client_secret)
+    logger.info("Deleting subscription: %s", subscription_id)
+    client = _graph_client(tenant_id, client_id, client_secret)
     client.delete_subscription(subscription_id)
-    logger.info(f"Deleted subscription: {subscription_id}")
+    logger.info("Deleted subscription: %s", subscription_id)
@@ -1,9 +1,14 @@
 """Utility functions for validation, logging, and helpers."""
 
+import hmac
 import logging
 import sys
 import re
-from typing import Optional
+from typing import Optional, Union
+
+_RESOURCE_RE = re.compile(r'/teams/([^/]+)/channels/([^/]+)/messages/([^/]+)')
+# Last message or reply segment, in path (messages/id) or OData (messages('id')) form
+_MESSAGE_ID_RE = re.compile(r"(?:messages|replies)(?:/([^/?']+)|\('([^']+)'\))/?$")
 
 
 def setup_logging(log_level: str = "INFO") -> None:
@@ -16,9 +21,18 @@ def setup_logging(log_level: str = "INFO") -> None:
     )
 
 
-def validate_client_state(received_state: Optional[str], expected_state: str) -> bool:
-    """Validate clientState from Graph notification."""
-    return received_state == expected_state if received_state else False
+def validate_client_state(received_state: Optional[str], expected_state: Union[str, bytes]) -> bool:
+    """
+    Validate clientState from Graph notification.
+    
+    Compares in constant time. Pass expected_state pre-encoded as bytes when
+    checking many notifications against the same secret.
+    """
+    if not received_state:
+        return False
+    if isinstance(expected_state, str):
+        expected_state = expected_state.encode("utf-8")
+    return hmac.compare_digest(received_state.encode("utf-8"), expected_state)
 
 
 def extract_resource_path(notification_data: dict) -> str:
@@ -42,8 +56,7 @@ def extract_resource_path(notification_data: dict) -> str:
 def parse_resource_ids(resource_path: str) -> dict:
     """Parse team, channel, and message IDs from resource path."""
     ids = {"team_id": None, "channel_id": None, "message_id": None}
-    pattern = r'/teams/([^/]+)/channels/([^/]+)/messages/([^/]+)'
-    match = re.search(pattern, resource_path)
+    match = _RESOURCE_RE.search(resource_path)
     
     if match:
         ids["team_id"] = match.group(1)
@@ -51,3 +64,11 @@ def parse_resource_ids(resource_path: str) -> dict:
         ids["message_id"] = match.group(3)
     
     return ids
+
+
+def resource_message_id(resource_path: str) -> Optional[str]:
+    """Get the ID of the message (or reply) a notification resource points to."""
+    match = _MESSAGE_ID_RE.search(resource_path)
+    if not match:
+        return None
+    return match.group(1) or match.group(2)
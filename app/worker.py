@@ -1,94 +1,218 @@
 """
 Background worker for processing Teams message notifications.
-Polls the database for pending notifications and fetches full message details.
+Picks up pending notifications from the database (woken by notify_new_work,
+with a slow poll as fallback) and fetches full message details.
 """
 
 import asyncio
 import logging
-from typing import Optional
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, List, Tuple, Union
+
+import orjson
+from cachetools import LRUCache
+from sqlalchemy import Row
 
 from app.storage import (
-    get_pending_notifications,
-    mark_notification_processing,
-    mark_notification_done,
-    mark_notification_failed,
-    save_message
+    claim_pending_notifications,
+    finalize_notification_batch,
+    get_recent_message_ids,
+    release_notifications
 )
 from app.graph_client import GraphClient
 from app.schema import normalize_message
+from app.utils import resource_message_id
 
 logger = logging.getLogger(__name__)
 
 # Global worker state
 _worker_task: Optional[asyncio.Task] = None
+_token_tasks: List[asyncio.Task] = []
 _worker_running = False
-_graph_client: Optional[GraphClient] = None
-_oauth_handler = None
-_tenant_id = None
-_client_id = None
-_client_secret = None
 
 
-async def process_notification(notification_id: int, resource: str, creator_id: Optional[str] = None) -> None:
+@dataclass(frozen=True)
+class WorkerContext:
+    """Clients the worker uses to fetch messages; fixed while it runs."""
+    
+    graph_client: GraphClient  # App-only client, the fallback for every fetch
+    oauth_handler: Any = None  # Provides delegated tokens when set
+
+
+_context: Optional[WorkerContext] = None
+
+# Caps the worker's Graph calls in flight (Settings.worker_concurrency);
+# created in start_worker on the running loop
+_graph_semaphore: Optional[asyncio.Semaphore] = None
+# Idle loop waits before polling anyway (e.g. for rows saved by another process):
+# starts short after work was found and grows by IDLE_POLL_BACKOFF up to the max
+MIN_IDLE_POLL_SECONDS = 0.25
+IDLE_POLL_SECONDS = 30
+IDLE_POLL_BACKOFF = 1.5
+# How long stop_worker lets the current batch finish before cancelling it
+SHUTDOWN_GRACE_SECONDS = 5
+# Set when new notifications are stored; created in start_worker on the running loop
+_wake_event: Optional[asyncio.Event] = None
+# IDs of messages already stored; storage keeps the first copy, so a
+# re-delivered notification for one of these is done without fetching it
+SEEN_MESSAGE_IDS = 10000
+_seen_message_ids: LRUCache = LRUCache(maxsize=SEEN_MESSAGE_IDS)
+
+
+def notify_new_work() -> None:
+    """Wake the worker loop now that new notifications are stored."""
+    if _wake_event is not None:
+        _wake_event.set()
+
+
+def _client_for(creator_id: Optional[str]) -> GraphClient:
     """
-    Process a single notification by fetching the message and normalizing it.
+    Pick the Graph client for a subscription's notifications.
     
     Args:
-        notification_id: Database notification ID
-        resource: Resource path to fetch
         creator_id: User ID who created the subscription (for delegated token)
-    """
-    try:
-        logger.info(f"Processing notification {notification_id}")
-        
-        # Mark as processing
-        mark_notification_processing(notification_id)
-        
-        # Determine which token to use
-        graph_client = None
-        if creator_id and _oauth_handler:
-            # Try to use creator's delegated token
-            user_token = _oauth_handler.get_valid_token(creator_id)
-            if user_token:
-                logger.info(f"Using delegated token for user {creator_id}")
-                graph_client = GraphClient(
-                    _tenant_id,
-                    _client_id,
-                    _client_secret,
-                    user_token=user_token
-                )
-            else:
-                logger.warning(f"No valid token for user {creator_id}, using app token")
-        
-        # Fall back to app token if no delegated token available
-        if not graph_client:
-            graph_client = _graph_client
-        
-        # Fetch message from Graph
-        message_data = graph_client.get_message(resource)
-        
-        # Normalize message
-        normalized = normalize_message(message_data)
-        
-        # Save to database
-        save_message(
-            message_id=normalized.message_id,
-            normalized_data=normalized.model_dump(mode='json'),
-            raw_data=message_data
-        )
-        
-        # Mark notification as done
-        mark_notification_done(notification_id)
         
-        logger.info(
-            f"Successfully processed notification {notification_id}, "
-            f"message {normalized.message_id}"
-        )
+    Returns:
+        A client with the creator's delegated token, or the app-only client
+    """
+    context = _context
+    if creator_id and context.oauth_handler:
+        # Try to use creator's delegated token
+        user_client = context.oauth_handler.get_graph_client(creator_id)
+        if user_client:
+            logger.info("Using delegated token for user %s", creator_id)
+            return user_client
+        logger.warning("No valid token for user %s, using app token", creator_id)
+    
+    # Fall back to app token if no delegated token available
+    return context.graph_client
+
+
+def _message_record(message: Dict[str, Any]) -> Tuple[str, str, str]:
+    """Normalize a Graph message into (message_id, normalized_json, raw_json)."""
+    normalized = normalize_message(message)
+    
+    # Both columns are stored as the JSON text built here. The Graph payload
+    # goes in raw_json only, not a second time inside normalized_json
+    return (
+        normalized.message_id,
+        normalized.model_dump_json(exclude={'raw_json'}),
+        orjson.dumps(message).decode()
+    )
+
+
+async def fetch_messages(graph_client: GraphClient,
+                         notifications: List[Row]) -> List[Union[Tuple[str, str, str], Exception]]:
+    """
+    Fetch and normalize the messages for notifications through Graph $batch.
+    
+    Args:
+        graph_client: Client whose token can read every resource
+        notifications: Notification rows (id, resource, creator_id)
         
+    Returns:
+        Per notification, (message_id, normalized_json, raw_json) or the error
+    """
+    try:
+        responses = await graph_client.get_messages_async([n.resource for n in notifications])
+    except Exception as e:
+        return [e] * len(notifications)
+    
+    results = []
+    for response in responses:
+        # An unexpected sub-response fails its own notification only
+        try:
+            status = response.get("status", 500) if response else 500
+            if status >= 400:
+                error = ((response or {}).get("body") or {}).get("error") or {}
+                results.append(Exception(f"Graph returned {status}: {error.get('message', 'no response')}"))
+                continue
+            results.append(_message_record(response["body"]))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+async def process_batch(notifications: List[Row]) -> None:
+    """
+    Process a batch of notifications, writing all results in one commit.
+    
+    Messages are fetched with one $batch call per token (app or subscription
+    creator), and those calls run concurrently.
+    
+    Args:
+        notifications: Claimed notification rows (id, resource, creator_id)
+    """
+    notification_ids = [n.id for n in notifications]
+    
+    done_ids = []
+    by_creator: Dict[Optional[str], List[Row]] = {}
+    for notification in notifications:
+        if resource_message_id(notification.resource) in _seen_message_ids:
+            logger.info("Message for notification %s already stored, skipping fetch", notification.id)
+            done_ids.append(notification.id)
+            continue
+        by_creator.setdefault(notification.creator_id, []).append(notification)
+    
+    async def fetch(creator_id: Optional[str], group: List[Row]) -> List[Union[Tuple[str, str, str], Exception]]:
+        async with _graph_semaphore:
+            # A cache miss in get_valid_token may refresh over the network
+            try:
+                graph_client = await asyncio.to_thread(_client_for, creator_id)
+            except Exception as e:
+                return [e] * len(group)
+            return await fetch_messages(graph_client, group)
+    
+    # One failed fetch (or group) doesn't affect the others
+    try:
+        group_results = await asyncio.gather(*(fetch(c, g) for c, g in by_creator.items()))
+    except asyncio.CancelledError:
+        # Stopped mid-fetch: hand the batch back for the next run
+        await asyncio.to_thread(release_notifications, notification_ids)
+        raise
+    
+    messages = []
+    failures = {}
+    for group, results in zip(by_creator.values(), group_results):
+        for notification, message in zip(group, results):
+            if isinstance(message, Exception):
+                logger.error("Failed to process notification %s: %s", notification.id, message)
+                failures[notification.id] = str(message)
+                continue
+            messages.append(message)
+            done_ids.append(notification.id)
+            logger.info("Successfully processed notification %s, message %s", notification.id, message[0])
+    
+    try:
+        await asyncio.to_thread(finalize_notification_batch, messages, done_ids, failures)
+        for message in messages:
+            _seen_message_ids[message[0]] = True
     except Exception as e:
-        error_msg = f"Failed to process notification {notification_id}: {e}"
-        logger.error(error_msg)
-        mark_notification_failed(notification_id, str(e))
+        # Put the whole batch back for retry rather than leaving it in processing
+        logger.error("Failed to store notification batch: %s", e)
+        try:
+            await asyncio.to_thread(
+                finalize_notification_batch, [], [], {i: f"Failed to store batch: {e}" for i in notification_ids}
+            )
+        except Exception as e:
+            # Nothing reclaims rows left in processing, so hand them back as unprocessed
+            logger.error("Failed to record batch failure, releasing the batch: %s", e)
+            await asyncio.to_thread(release_notifications, notification_ids)
+
+
+async def _claim(limit: int) -> List[Row]:
+    """
+    Claim pending notifications in a thread.
+    
+    If cancelled meanwhile, the claim still completes in its thread, so its
+    rows are released before the cancellation is passed on.
+    """
+    claim = asyncio.ensure_future(asyncio.to_thread(claim_pending_notifications, limit=limit))
+    try:
+        return await asyncio.shield(claim)
+    except asyncio.CancelledError:
+        await asyncio.to_thread(release_notifications, [n.id for n in await claim])
+        raise
 
 
 async def worker_loop() -> None:
@@ -96,38 +220,73 @@ async def worker_loop() -> None:
     Main worker loop that polls for pending notifications.
     """
     logger.info("Worker loop started")
+    poll_interval = MIN_IDLE_POLL_SECONDS
+    batch_size = GraphClient.BATCH_MAX_REQUESTS
+    # Claimed ahead of time; still processed if the worker is stopped meanwhile
+    notifications: List[Row] = []
     
-    while _worker_running:
+    while _worker_running or notifications:
         try:
-            # Get pending notifications
-            notifications = get_pending_notifications(limit=10)
+            if not notifications:
+                # Cleared before the query so a notify during it isn't lost
+                _wake_event.clear()
+                
+                # Claim pending notifications (already marked processing)
+                notifications = await _claim(batch_size)
             
             if notifications:
-                logger.info(f"Found {len(notifications)} pending notifications")
+                logger.info("Found %s pending notifications", len(notifications))
+                
+                # A full batch suggests more are waiting: claim the next one
+                # while this one is fetched from Graph
+                next_batch = None
+                if _worker_running and len(notifications) == batch_size:
+                    _wake_event.clear()
+                    next_batch = asyncio.create_task(_claim(batch_size))
                 
-                # Process each notification
-                for notification in notifications:
-                    if not _worker_running:
-                        break
-                    
-                    await process_notification(
-                        notification.id,
-                        notification.resource,
-                        notification.creator_id
-                    )
+                try:
+                    await process_batch(notifications)
+                finally:
+                    notifications = []
+                    if next_batch:
+                        notifications = await next_batch
+                poll_interval = MIN_IDLE_POLL_SECONDS
                 
             else:
-                # No notifications, sleep before next poll
-                await asyncio.sleep(5)
+                # No notifications, wait until notify_new_work() or the next poll
+                try:
+                    await asyncio.wait_for(_wake_event.wait(), timeout=poll_interval)
+                except asyncio.TimeoutError:
+                    poll_interval = min(poll_interval * IDLE_POLL_BACKOFF, IDLE_POLL_SECONDS)
                 
+        except asyncio.CancelledError:
+            # Hand back a batch claimed ahead of time before stopping
+            await asyncio.to_thread(release_notifications, [n.id for n in notifications])
+            raise
         except Exception as e:
-            logger.error(f"Worker loop error: {e}")
+            logger.error("Worker loop error: %s", e)
             await asyncio.sleep(10)  # Back off on error
     
     logger.info("Worker loop stopped")
 
 
-async def start_worker(tenant_id: str, client_id: str, client_secret: str, oauth_handler=None) -> None:
+async def session_refresh_loop(interval: int = 60) -> None:
+    """
+    Periodically refresh delegated tokens that are about to expire.
+    
+    Args:
+        interval: Seconds between checks
+    """
+    while _worker_running:
+        try:
+            await asyncio.to_thread(_context.oauth_handler.refresh_expiring_sessions)
+        except Exception as e:
+            logger.error("Session refresh error: %s", e)
+        await asyncio.sleep(interval)
+
+
+async def start_worker(tenant_id: str, client_id: str, client_secret: str, oauth_handler=None, *,
+                       concurrency: int) -> None:
     """
     Start the background worker.
     
@@ -136,8 +295,10 @@ async def start_worker(tenant_id: str, client_id: str, client_secret: str, oauth
         client_id: Application client ID
         client_secret: Client secret
         oauth_handler: OAuth handler for delegated tokens (optional)
+        concurrency: Graph calls to have in flight at once (Settings.worker_concurrency)
     """
-    global _worker_task, _worker_running, _graph_client, _oauth_handler, _tenant_id, _client_id, _client_secret
+    global _worker_task, _worker_running, _wake_event, _context
+    global _graph_semaphore
     
     if _worker_running:
         logger.warning("Worker already running")
@@ -145,19 +306,28 @@ async def start_worker(tenant_id: str, client_id: str, client_secret: str, oauth
     
     logger.info("Starting background worker")
     
-    # Store credentials for creating per-user clients
-    _tenant_id = tenant_id
-    _client_id = client_id
-    _client_secret = client_secret
-    _oauth_handler = oauth_handler
+    # App-only client as the fallback; the OAuth handler provides per-user clients
+    _context = WorkerContext(
+        graph_client=GraphClient(tenant_id, client_id, client_secret),
+        oauth_handler=oauth_handler
+    )
     
-    # Initialize Graph client for app-only access (fallback)
-    _graph_client = GraphClient(tenant_id, client_id, client_secret)
+    # Seed the seen-message cache, oldest first so the newest are evicted last
+    _seen_message_ids.clear()
+    for message_id in reversed(await asyncio.to_thread(get_recent_message_ids, SEEN_MESSAGE_IDS)):
+        _seen_message_ids[message_id] = True
     
     # Start worker loop
     _worker_running = True
+    _wake_event = asyncio.Event()
+    _graph_semaphore = asyncio.Semaphore(max(1, concurrency))
     _worker_task = asyncio.create_task(worker_loop())
     
+    # Keep app and delegated tokens fresh off the request path
+    _token_tasks.append(asyncio.create_task(_context.graph_client.keep_token_fresh()))
+    if oauth_handler:
+        _token_tasks.append(asyncio.create_task(session_refresh_loop()))
+    
     logger.info("Background worker started")
 
 
@@ -174,11 +344,18 @@ async def stop_worker() -> None:
     logger.info("Stopping background worker")
     
     _worker_running = False
+    notify_new_work()
+    
+    for task in _token_tasks:
+        task.cancel()
+    await asyncio.gather(*_token_tasks, return_exceptions=True)
+    _token_tasks.clear()
     
     if _worker_task:
-        # Wait for worker to finish current work
+        # Let the current batch finish briefly; when cancelled, the worker
+        # puts claimed notifications back to pending
         try:
-            await asyncio.wait_for(_worker_task, timeout=30)
+            await asyncio.wait_for(_worker_task, timeout=SHUTDOWN_GRACE_SECONDS)
         except asyncio.TimeoutError:
             logger.warning("Worker did not stop gracefully, cancelling")
             _worker_task.cancel()
@@ -0,0 +1,114 @@
+"""
+Tests for OAuth token handling.
+"""
+
+import base64
+import json
+import time
+from unittest.mock import Mock, patch
+
+from app.auth import OAuthHandler, OAuthSession
+
+
+def _make_jwt(claims):
+    """Build an unsigned JWT carrying the given claims."""
+    def encode(part):
+        return base64.urlsafe_b64encode(json.dumps(part).encode()).rstrip(b"=").decode()
+    return f"{encode({'alg': 'none'})}.{encode(claims)}.signature"
+
+
+def _handler():
+    return OAuthHandler("tenant", "client", "secret", "https://example.com/auth/callback")
+
+
+def test_user_from_claims():
+    """Test that user ID and email are read from the token payload."""
+    token = _make_jwt({"oid": "user-123", "upn": "john@example.com"})
+    assert OAuthHandler._user_from_claims(token) == ("user-123", "john@example.com")
+
+    token = _make_jwt({"oid": "user-456", "preferred_username": "jane@example.com"})
+    assert OAuthHandler._user_from_claims(token) == ("user-456", "jane@example.com")
+
+
+def test_user_from_claims_opaque_token():
+    """Test that non-JWT tokens yield no claims."""
+    assert OAuthHandler._user_from_claims("opaque-token") == (None, None)
+    assert OAuthHandler._user_from_claims("a.!!!.c") == (None, None)
+
+
+@patch("app.auth.get_http_client")
+def test_exchange_code_skips_me_lookup(mock_get_http_client):
+    """Test that a login with a JWT access token does not call /me."""
+    token_response = Mock()
+    token_response.content = json.dumps({
+        "access_token": _make_jwt({"oid": "user-123", "upn": "john@example.com"}),
+        "refresh_token": "refresh",
+        "expires_in": 3600,
+    }).encode()
+    mock_get_http_client.return_value.post.return_value = token_response
+
+    handler = _handler()
+    session = handler.exchange_code_for_token("auth-code")
+
+    assert session.user_id == "user-123"
+    assert session.user_email == "john@example.com"
+    assert handler.get_session("user-123") is session
+    mock_get_http_client.return_value.get.assert_not_called()
+
+
+def test_logout_removes_session():
+    """Test that logout drops the stored session."""
+    handler = _handler()
+    session = OAuthSession("token", "refresh", time.time() + 3600, "user-1", "a@b.c")
+    handler.store.set("user-1", session)
+    assert handler.get_valid_token("user-1") == "token"
+
+    handler.logout("user-1")
+
+    assert handler.get_session("user-1") is None
+    assert handler.get_valid_token("user-1") is None
+
+
+def test_get_valid_token_uses_cache():
+    """Test that repeated token lookups skip the session store."""
+    handler = _handler()
+    handler.store.set("user-1", OAuthSession("token", "refresh", time.time() + 3600, "user-1", "a@b.c"))
+
+    with patch.object(handler.store, "get", wraps=handler.store.get) as mock_get:
+        assert handler.get_valid_token("user-1") == "token"
+        assert handler.get_valid_token("user-1") == "token"
+
+    assert mock_get.call_count == 1
+
+
+def test_get_graph_client_is_cached_per_user_until_token_changes():
+    """Test that a user's client is reused, replaced after a refresh, and dropped on logout."""
+    handler = _handler()
+    session = OAuthSession("token-1", "refresh", time.time() + 3600, "user-1", "a@b.c")
+    handler.store.set("user-1", session)
+
+    first = handler.get_graph_client("user-1")
+    assert handler.get_graph_client("user-1") is first
+
+    session.access_token = "token-2"
+    handler.store.set("user-1", session)
+    handler._forget_token("user-1")
+    second = handler.get_graph_client("user-1")
+    assert second is not first
+    assert second.get_access_token() == "token-2"
+    assert len(handler._client_cache) == 1
+
+    handler.logout("user-1")
+    assert handler.get_graph_client("user-1") is None
+    assert len(handler._client_cache) == 0
+
+
+def test_session_expiry_and_legacy_serialization():
+    """Test epoch expiry checks and loading sessions stored with ISO timestamps."""
+    session = OAuthSession("token", "refresh", time.time() + 60, "user-1", "a@b.c")
+    assert session.is_expired()
+    assert OAuthSession.from_dict(session.to_dict()).expires_at == session.expires_at
+
+    legacy = session.to_dict()
+    legacy["expires_at"] = "2030-01-01T00:00:00"
+    assert OAuthSession.from_dict(legacy).expires_at == 1893456000.0
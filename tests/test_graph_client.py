@@ -0,0 +1,189 @@
+"""
+Tests for Graph client request batching.
+"""
+
+import threading
+import time
+
+import httpx
+import orjson
+import pytest
+from unittest.mock import Mock, patch
+
+from app.graph_client import GraphClient, _normalize_resource_path
+
+
+def _batch_reply(envelope, status=200, headers=None):
+    """Build a fake $batch response echoing every request id."""
+    return {
+        "responses": [
+            {"id": req["id"], "status": status, "headers": headers or {}, "body": {"url": req["url"]}}
+            for req in reversed(envelope["requests"])
+        ]
+    }
+
+
+def _response(body):
+    """Build a fake HTTP response with a JSON body."""
+    response = Mock()
+    response.content = orjson.dumps(body)
+    return response
+
+
+def test_batch_chunks_requests_and_preserves_order():
+    """Test that batch splits steps into groups of 20 and reorders responses."""
+    client = GraphClient("tenant", "client", "secret")
+    steps = [{"method": "GET", "url": f"/subscriptions/{i}"} for i in range(45)]
+
+    with patch.object(client, "_make_request", side_effect=lambda m, u, json: _response(_batch_reply(json))) as mock_request:
+        results = client.batch(steps)
+
+    assert mock_request.call_count == 3
+    sizes = [len(call.kwargs["json"]["requests"]) for call in mock_request.call_args_list]
+    assert sizes == [20, 20, 5]
+    assert [r["body"]["url"] for r in results] == [s["url"] for s in steps]
+
+
+def test_batch_adds_content_type_for_bodies():
+    """Test that steps with a body get a JSON content type header."""
+    request = GraphClient._batch_request(3, {"method": "PATCH", "url": "/subscriptions/x", "body": {"a": 1}})
+
+    assert request == {
+        "id": "3",
+        "method": "PATCH",
+        "url": "/subscriptions/x",
+        "body": {"a": 1},
+        "headers": {"Content-Type": "application/json"},
+    }
+
+
+@patch("app.graph_client.time.sleep")
+def test_batch_retries_throttled_steps(mock_sleep):
+    """Test that throttled sub-requests are resent on their own."""
+    client = GraphClient("tenant", "client", "secret")
+    steps = [{"method": "DELETE", "url": f"/subscriptions/{i}"} for i in range(3)]
+
+    def reply(method, url, json):
+        if len(json["requests"]) == 3:
+            body = _batch_reply(json)
+            body["responses"][0].update(status=429, headers={"Retry-After": "2"})
+            return _response(body)
+        return _response(_batch_reply(json, status=204))
+
+    with patch.object(client, "_make_request", side_effect=reply) as mock_request:
+        results = client.batch(steps)
+
+    assert mock_request.call_count == 2
+    retried = mock_request.call_args_list[1].kwargs["json"]["requests"]
+    assert [r["url"] for r in retried] == ["/subscriptions/2"]
+    mock_sleep.assert_called_once_with(2)
+    assert [r["status"] for r in results] == [200, 200, 204]
+
+
+@patch("app.graph_client.time.sleep")
+def test_batch_falls_back_when_retry_after_is_not_seconds(mock_sleep):
+    """Test that an HTTP-date or fractional Retry-After on a sub-response doesn't abort the batch."""
+    client = GraphClient("tenant", "client", "secret")
+    steps = [{"method": "DELETE", "url": f"/subscriptions/{i}"} for i in range(2)]
+
+    calls = []
+
+    def reply(method, url, json):
+        calls.append(json)
+        body = _batch_reply(json, status=204)
+        if len(calls) == 1:
+            body["responses"][0].update(status=429, headers={"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})
+            body["responses"][1].update(status=503, headers={"Retry-After": "0.5"})
+        return _response(body)
+
+    with patch.object(client, "_make_request", side_effect=reply):
+        results = client.batch(steps)
+
+    mock_sleep.assert_called_once_with(GraphClient.RETRY_DELAY)
+    assert [r["status"] for r in results] == [204, 204]
+
+
+@patch("app.graph_client.get_http_client")
+def test_concurrent_token_requests_are_coalesced(mock_get_http_client):
+    """Test that threads racing on an expired token trigger one token request."""
+    def slow_post(*args, **kwargs):
+        time.sleep(0.05)
+        return _response({"access_token": "token-1", "expires_in": 3600})
+
+    mock_get_http_client.return_value.post.side_effect = slow_post
+    client = GraphClient("tenant", "client", "secret")
+
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(client.get_access_token())) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert tokens == ["token-1"] * 5
+    assert mock_get_http_client.return_value.post.call_count == 1
+
+
+def _status_response(status, headers=None):
+    """Build a fake HTTP response with the given status code."""
+    request = httpx.Request("GET", "https://graph.microsoft.com/v1.0/subscriptions")
+    return httpx.Response(status, headers=headers, json={}, request=request)
+
+
+@patch("app.graph_client.time.sleep")
+@patch("app.graph_client.get_http_client")
+def test_make_request_retries_transient_status_with_jitter(mock_get_http_client, mock_sleep):
+    """Test that 503 responses are retried after Retry-After plus jitter."""
+    mock_get_http_client.return_value.request.side_effect = [
+        _status_response(503, {"Retry-After": "2"}),
+        _status_response(200),
+    ]
+    client = GraphClient("tenant", "client", "secret", user_token="token")
+
+    response = client._make_request("GET", "/subscriptions")
+
+    assert response.status_code == 200
+    assert mock_get_http_client.return_value.request.call_args.kwargs["auth"].header == "Bearer token"
+    delay = mock_sleep.call_args.args[0]
+    assert 2 <= delay <= 2 + GraphClient.RETRY_JITTER
+
+
+@patch("app.graph_client.time.sleep")
+@patch("app.graph_client.get_http_client")
+def test_make_request_does_not_retry_client_errors(mock_get_http_client, mock_sleep):
+    """Test that non-retryable statuses fail on the first attempt."""
+    mock_get_http_client.return_value.request.return_value = _status_response(404)
+    client = GraphClient("tenant", "client", "secret", user_token="token")
+
+    with pytest.raises(Exception, match="after 1 attempts"):
+        client._make_request("GET", "/subscriptions")
+
+    assert mock_get_http_client.return_value.request.call_count == 1
+    mock_sleep.assert_not_called()
+
+
+@pytest.mark.parametrize("resource, expected", [
+    ("https://graph.microsoft.com/v1.0/teams/t/channels/c/messages/m", "/teams/t/channels/c/messages/m"),
+    ("/beta/chats/c/messages/m", "/chats/c/messages/m"),
+    ("teams('t')/channels('c')/messages('m')", "/teams('t')/channels('c')/messages('m')"),
+    ("/chats/c/messages/m", "/chats/c/messages/m"),
+])
+def test_normalize_resource_path(resource, expected):
+    """Test that notification resources are reduced to Graph paths."""
+    assert _normalize_resource_path(resource) == expected
+
+
+def test_list_subscriptions_follows_next_link():
+    """Test that every page of subscriptions is returned."""
+    client = GraphClient("tenant", "client", "secret")
+    next_link = "https://graph.microsoft.com/v1.0/subscriptions?$skiptoken=abc"
+    pages = [
+        _response({"value": [{"id": "a"}, {"id": "b"}], "@odata.nextLink": next_link}),
+        _response({"value": [{"id": "c"}]}),
+    ]
+
+    with patch.object(client, "_make_request", side_effect=pages) as mock_request:
+        subscriptions = client.list_subscriptions()
+
+    assert [s["id"] for s in subscriptions] == ["a", "b", "c"]
+    assert mock_request.call_args_list[1].args == ("GET", next_link)
@@ -0,0 +1,161 @@
+"""
+Tests for the webhook endpoint and its notification save queue.
+"""
+
+import asyncio
+import time
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import OperationalError
+
+import app.main as main
+from app.config import get_settings
+from app.storage import Notification, get_db, save_notifications_bulk
+
+
+async def _noop(*args, **kwargs):
+    """Stand-in for the background worker's start and stop."""
+
+
+@pytest.fixture
+def client(mock_env_vars, monkeypatch, tmp_path):
+    """App client on a file database (saves run in a thread), without the background worker."""
+    monkeypatch.setenv("DB_PATH", f"sqlite:///{tmp_path / 'teams.db'}")
+    get_settings.cache_clear()
+    with patch.object(main, "start_worker", _noop), patch.object(main, "stop_worker", _noop):
+        yield TestClient(main.app)
+    get_settings.cache_clear()
+
+
+def _notification(resource="chats/c/messages/1", client_state="test-secret"):
+    """Build a webhook body with one notification."""
+    return {"value": [{"subscriptionId": "sub-1", "clientState": client_state, "changeType": "created",
+                       "resource": resource}]}
+
+
+def _locked():
+    """The error SQLite raises while another connection holds the write lock."""
+    return OperationalError("INSERT INTO notifications", {}, Exception("database is locked"))
+
+
+def _stored_resources():
+    """Resources of every stored notification, in insert order."""
+    with get_db().get_session() as session:
+        return [n.resource for n in session.query(Notification).order_by(Notification.id)]
+
+
+def test_webhook_queues_notifications_and_saves_them(client):
+    """Test that the webhook answers 202 and valid notifications end up stored."""
+    with client:
+        response = client.post("/graph-webhook", json=_notification())
+        rejected = client.post("/graph-webhook", json=_notification(client_state="wrong"))
+
+    assert response.status_code == 202
+    assert rejected.status_code == 202
+    assert _stored_resources() == ["chats/c/messages/1"]
+
+
+def test_webhook_skips_notifications_with_malformed_fields(client):
+    """Test that a notification whose subscriptionId or resource isn't a string is skipped, not queued."""
+    body = _notification(resource={"a": 1})
+    body["value"].append({**_notification()["value"][0], "subscriptionId": 42})
+    body["value"].append(_notification(resource="chats/c/messages/2")["value"][0])
+
+    with client:
+        response = client.post("/graph-webhook", json=body)
+
+    assert response.status_code == 202
+    assert _stored_resources() == ["chats/c/messages/2"]
+
+
+def test_webhook_rejects_with_503_when_queue_is_full(client):
+    """Test that a full save queue sheds load with 503 so Graph redelivers."""
+    with client:
+        full_queue = asyncio.Queue(maxsize=1)
+        full_queue.put_nowait([])
+        with patch.object(main, "notification_queue", full_queue):
+            response = client.post("/graph-webhook", json=_notification())
+
+    assert response.status_code == 503
+
+
+def test_failed_save_is_retried(client, monkeypatch):
+    """Test that a batch whose insert hits a locked database is saved on a later attempt, not dropped."""
+    monkeypatch.setattr(main, "SAVE_RETRY_DELAY", 0.01)
+    calls = []
+
+    def flaky_save(notifications):
+        calls.append(len(notifications))
+        if len(calls) == 1:
+            raise _locked()
+        return save_notifications_bulk(notifications)
+
+    with patch.object(main, "save_notifications_bulk", flaky_save):
+        with client:
+            client.post("/graph-webhook", json=_notification())
+
+    assert calls == [1, 1]
+    assert _stored_resources() == ["chats/c/messages/1"]
+
+
+def test_shutdown_flushes_batches_the_saver_could_not_finish(client, monkeypatch):
+    """Test that notifications still queued when shutdown gives up waiting are saved by the final flush."""
+    monkeypatch.setattr(main, "SAVE_RETRY_DELAY", 60)
+    monkeypatch.setattr(main, "SHUTDOWN_SAVE_TIMEOUT", 0.1)
+    calls = []
+
+    def save_after_first_failure(notifications):
+        calls.append(len(notifications))
+        if len(calls) == 1:
+            raise _locked()
+        return save_notifications_bulk(notifications)
+
+    with patch.object(main, "save_notifications_bulk", save_after_first_failure):
+        with client:
+            client.post("/graph-webhook", json=_notification())
+
+    assert calls == [1, 1]
+    assert _stored_resources() == ["chats/c/messages/1"]
+
+
+def test_failed_save_stores_the_good_notifications(client):
+    """Test that a batch failing for a non-transient reason is saved item by item, dropping only the bad one."""
+    calls = []
+
+    def save_rejecting_one(notifications):
+        calls.append(len(notifications))
+        if any(n["resource"] == "chats/c/messages/bad" for n in notifications):
+            raise ValueError("bad notification")
+        return save_notifications_bulk(notifications)
+
+    body = _notification()
+    body["value"] += [_notification(resource=r)["value"][0] for r in ("chats/c/messages/bad", "chats/c/messages/2")]
+    with patch.object(main, "save_notifications_bulk", save_rejecting_one):
+        with client:
+            client.post("/graph-webhook", json=body)
+
+    assert calls == [3, 1, 1, 1]
+    assert _stored_resources() == ["chats/c/messages/1", "chats/c/messages/2"]
+
+
+def test_save_retries_stop_after_max_attempts(client, monkeypatch):
+    """Test that a database that stays locked is retried SAVE_MAX_ATTEMPTS times, then items are tried singly."""
+    monkeypatch.setattr(main, "SAVE_RETRY_DELAY", 0)
+    calls = []
+
+    def always_locked(notifications):
+        calls.append(len(notifications))
+        raise _locked()
+
+    with patch.object(main, "save_notifications_bulk", always_locked):
+        with client:
+            client.post("/graph-webhook", json=_notification())
+            deadline = time.monotonic() + 5
+            while len(calls) <= main.SAVE_MAX_ATTEMPTS and time.monotonic() < deadline:
+                time.sleep(0.01)
+            later = client.post("/graph-webhook", json=_notification(resource="chats/c/messages/2"))
+
+    assert later.status_code == 202
+    assert calls == [1] * (main.SAVE_MAX_ATTEMPTS + 1) * 2
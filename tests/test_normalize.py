@@ -21,7 +21,14 @@ def test_strip_html():
     # Multiple spaces
     html = "<p>Too    many   spaces</p>"
     assert strip_html(html) == "Too many spaces"
-    
+
+    # Whitespace and &nbsp; around tags collapse to one space
+    html = "<p>\n  Hi&nbsp;<at id=\"0\">Bob</at> &nbsp;<br/>\tit&#39;s done  </p>"
+    assert strip_html(html) == "Hi Bob it's done"
+
+    # Numeric and named entities beyond the basic five
+    assert strip_html("It&#8217;s &copy; 2025") == "It\u2019s \u00a9 2025"
+
     # Empty
     assert strip_html("") == ""
     assert strip_html(None) == ""
@@ -180,3 +187,24 @@ def test_normalize_message_preserves_raw_json():
     
     assert normalized.raw_json == graph_message
     assert "customField" in normalized.raw_json
+
+
+def test_normalize_message_with_null_sender():
+    """Test that system messages with null sender and mention user still normalize."""
+    graph_message = {
+        "id": "sys-1",
+        "createdDateTime": "2025-11-22T10:30:00Z",
+        "from": None,
+        "body": {"contentType": "html", "content": None},
+        "mentions": [{"mentionText": "Team", "mentioned": {"user": None, "tag": {"id": "t"}}}],
+        "attachments": None
+    }
+    
+    normalized = normalize_message(graph_message)
+    
+    assert normalized.sender_id is None
+    assert normalized.sender_name is None
+    assert normalized.body_text == ""
+    assert normalized.mentions[0].user_id is None
+    assert normalized.mentions[0].mentioned_text == "Team"
+    assert normalized.attachments == []
@@ -0,0 +1,130 @@
+"""
+Tests for notification and message storage.
+"""
+
+import orjson
+
+from app.storage import (
+    MAX_NOTIFICATION_ATTEMPTS,
+    Message,
+    Notification,
+    claim_pending_notifications,
+    finalize_notification_batch,
+    get_message_by_id,
+    get_recent_message_ids,
+    init_db,
+    release_notifications,
+    save_messages_bulk,
+    save_notifications_bulk,
+)
+
+
+def test_save_notifications_bulk():
+    """Test that a batch of notifications is stored in one call, IDs in order."""
+    db = init_db("sqlite:///:memory:")
+    notifications = [
+        {"subscription_id": "sub-1", "resource": "teams/t/channels/c/messages/1", "payload": '{"n":1}'},
+        {"subscription_id": "sub-2", "resource": "chats/c/messages/2", "payload": {"n": 2}, "creator_id": "user-1"},
+    ]
+
+    ids = save_notifications_bulk(notifications)
+
+    with db.get_session() as session:
+        stored = [session.get(Notification, i) for i in ids]
+    assert [n.subscription_id for n in stored] == ["sub-1", "sub-2"]
+    assert [orjson.loads(n.payload_json) for n in stored] == [{"n": 1}, {"n": 2}]
+    assert stored[1].creator_id == "user-1"
+    assert all(n.status == "pending" and n.attempts == 0 and n.created_at for n in stored)
+
+
+def test_save_messages_bulk_skips_existing():
+    """Test that bulk message saves insert new rows once and skip duplicates."""
+    db = init_db("sqlite:///:memory:")
+    save_messages_bulk([("m1", {"message_id": "m1"}, {"id": "m1"})])
+
+    inserted = save_messages_bulk([
+        ("m1", {"message_id": "m1", "changed": True}, {"id": "m1"}),
+        ("m2", {"message_id": "m2"}, {"id": "m2"}),
+        ("m2", {"message_id": "m2"}, {"id": "m2"}),
+    ])
+
+    assert inserted == 1
+    with db.get_session() as session:
+        stored = {m.message_id: m for m in session.query(Message).all()}
+    assert set(stored) == {"m1", "m2"}
+    assert orjson.loads(stored["m1"].normalized_json) == {"message_id": "m1"}
+    assert stored["m2"].ingested_at is not None
+
+
+def test_file_database_splits_reader_and_writer(tmp_path):
+    """Test that a file database reads committed writes through a separate reader pool."""
+    db = init_db(f"sqlite:///{tmp_path / 'teams.db'}")
+    save_messages_bulk([("m1", {"message_id": "m1"}, {"id": "m1"})])
+
+    assert db.read_engine is not db.engine
+    assert db.engine.pool.size() == 1
+    assert get_message_by_id("m1").message_id == "m1"
+
+
+def test_finalize_notification_batch():
+    """Test that a batch's messages and status changes are written together."""
+    db = init_db("sqlite:///:memory:")
+    ids = save_notifications_bulk([
+        {"subscription_id": "sub", "resource": f"chats/c/messages/{i}", "payload": {}} for i in range(3)
+    ])
+    with db.get_session() as session:
+        session.get(Notification, ids[2]).attempts = MAX_NOTIFICATION_ATTEMPTS - 1
+        session.commit()
+
+    claim_pending_notifications()
+    finalize_notification_batch(
+        [("m0", {"message_id": "m0"}, {"id": "m0"})],
+        [ids[0]],
+        {ids[1]: "boom", ids[2]: "boom again"}
+    )
+
+    with db.get_session() as session:
+        stored = [session.get(Notification, i) for i in ids]
+        assert session.query(Message).filter(Message.message_id == "m0").count() == 1
+    assert [(n.status, n.attempts) for n in stored] == [("done", 1), ("pending", 1), ("failed", MAX_NOTIFICATION_ATTEMPTS)]
+    assert stored[1].error_message == "boom"
+
+
+def test_claim_pending_notifications():
+    """Test that claiming marks the oldest pending notifications processing and skips claimed ones."""
+    init_db("sqlite:///:memory:")
+    ids = save_notifications_bulk([
+        {"subscription_id": "sub", "resource": f"chats/c/messages/{i}", "payload": {}} for i in range(3)
+    ])
+
+    first = claim_pending_notifications(limit=2)
+    second = claim_pending_notifications(limit=2)
+
+    assert [n.id for n in first] == ids[:2]
+    assert first[0].resource == "chats/c/messages/0"
+    assert [n.id for n in second] == ids[2:]
+    assert claim_pending_notifications() == []
+
+
+def test_get_recent_message_ids():
+    """Test that the most recently stored message IDs come back newest first."""
+    init_db("sqlite:///:memory:")
+    save_messages_bulk([(f"m{i}", {"message_id": f"m{i}"}, {"id": f"m{i}"}) for i in range(3)])
+
+    assert get_recent_message_ids(limit=2) == ["m2", "m1"]
+
+
+def test_release_notifications():
+    """Test that released notifications are pending again without a counted attempt."""
+    db = init_db("sqlite:///:memory:")
+    ids = save_notifications_bulk([
+        {"subscription_id": "sub", "resource": f"chats/c/messages/{i}", "payload": {}} for i in range(2)
+    ])
+    claim_pending_notifications()
+    finalize_notification_batch([], [ids[0]], {})
+
+    release_notifications(ids)
+
+    with db.get_session() as session:
+        stored = [session.get(Notification, i) for i in ids]
+    assert [(n.status, n.attempts) for n in stored] == [("done", 1), ("pending", 0)]
@@ -5,7 +5,15 @@ Tests for subscription creation.
 import pytest
 from unittest.mock import Mock, patch, MagicMock
 
-from app.subscription import create_teams_subscription
+from app.subscription import _graph_client, create_teams_subscription
+
+
+@pytest.fixture(autouse=True)
+def clear_graph_client_cache():
+    """Give each test a fresh (patched) GraphClient instead of a cached one."""
+    _graph_client.cache_clear()
+    yield
+    _graph_client.cache_clear()
 
 
 @patch('app.subscription.GraphClient')
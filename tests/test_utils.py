@@ -0,0 +1,29 @@
+"""
+Tests for utility helpers.
+"""
+
+from app.utils import parse_resource_ids, resource_message_id, validate_client_state
+
+
+def test_validate_client_state():
+    """Test clientState comparison against str and pre-encoded secrets."""
+    assert validate_client_state("test-secret", "test-secret")
+    assert validate_client_state("test-secret", b"test-secret")
+    assert not validate_client_state("wrong", b"test-secret")
+    assert not validate_client_state(None, b"test-secret")
+    assert not validate_client_state("", "test-secret")
+
+
+def test_parse_resource_ids():
+    """Test team, channel and message IDs are read from a channel message path."""
+    ids = parse_resource_ids("/teams/t1/channels/19:c1@thread.tacv2/messages/m1")
+    assert ids == {"team_id": "t1", "channel_id": "19:c1@thread.tacv2", "message_id": "m1"}
+    assert parse_resource_ids("/chats/c/messages/m") == {"team_id": None, "channel_id": None, "message_id": None}
+
+
+def test_resource_message_id():
+    """Test the message or reply ID is read from path and OData style resources."""
+    assert resource_message_id("chats/c/messages/m1") == "m1"
+    assert resource_message_id("teams('t')/channels('19:c@thread.tacv2')/messages('17')") == "17"
+    assert resource_message_id("chats('19:x')/messages('17')/replies('18')") == "18"
+    assert resource_message_id("/subscriptions/s1") is None
@@ -0,0 +1,179 @@
+"""
+Tests for the background worker's batch processing, prefetch and shutdown.
+"""
+
+import asyncio
+
+import pytest
+
+import app.worker as worker
+from app.storage import Message, Notification, claim_pending_notifications, get_db, init_db, save_notifications_bulk
+
+
+class FakeGraphClient:
+    """Answers $batch fetches with a message per resource, optionally holding them until released."""
+
+    def __init__(self, hold=False):
+        self.requests = []
+        self.fetching = asyncio.Event()
+        self.release = asyncio.Event()
+        if not hold:
+            self.release.set()
+
+    async def get_messages_async(self, resource_paths):
+        self.requests.append(list(resource_paths))
+        self.fetching.set()
+        await self.release.wait()
+        return [
+            {"id": str(i), "status": 200,
+             "body": {"id": path.rsplit("/", 1)[-1], "createdDateTime": "2025-11-22T10:30:00Z"}}
+            for i, path in enumerate(resource_paths)
+        ]
+
+
+@pytest.fixture
+def worker_db(tmp_path):
+    """File database (the worker saves in threads) and an empty seen-message cache."""
+    init_db(f"sqlite:///{tmp_path / 'teams.db'}")
+    worker._seen_message_ids.clear()
+    yield
+    worker._seen_message_ids.clear()
+
+
+def _save_notifications(count):
+    """Store pending notifications for messages 0..count-1."""
+    return save_notifications_bulk([
+        {"subscription_id": "sub", "resource": f"chats/c/messages/{i}", "payload": {}} for i in range(count)
+    ])
+
+
+def _stored_notifications():
+    """(status, attempts) of every notification, in insert order."""
+    with get_db().get_read_session() as session:
+        return [(n.status, n.attempts) for n in session.query(Notification).order_by(Notification.id)]
+
+
+def _stored_message_ids():
+    """IDs of every stored message."""
+    with get_db().get_read_session() as session:
+        return {m.message_id for m in session.query(Message)}
+
+
+async def _wait_until(condition, timeout=5):
+    """Poll until condition() holds; fail the test on timeout."""
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+
+def _use_worker(monkeypatch, graph_client):
+    """Set up worker state as start_worker would, without the token tasks; call on the running loop."""
+    monkeypatch.setattr(worker, "_context", worker.WorkerContext(graph_client=graph_client))
+    monkeypatch.setattr(worker, "_graph_semaphore", asyncio.Semaphore(4))
+    monkeypatch.setattr(worker, "_wake_event", asyncio.Event())
+    monkeypatch.setattr(worker, "_worker_running", True)
+    monkeypatch.setattr(worker, "_worker_task", None)
+
+
+def test_next_batch_is_claimed_while_one_is_in_flight(worker_db, monkeypatch):
+    """Test that a full batch being fetched doesn't stop the worker claiming the next one."""
+    _save_notifications(25)
+
+    async def scenario():
+        fake = FakeGraphClient(hold=True)
+        _use_worker(monkeypatch, fake)
+        task = asyncio.create_task(worker.worker_loop())
+
+        await asyncio.wait_for(fake.fetching.wait(), 5)
+        await _wait_until(lambda: all(status == "processing" for status, _ in _stored_notifications()))
+        assert [len(r) for r in fake.requests] == [20]
+
+        fake.release.set()
+        await _wait_until(lambda: all(status == "done" for status, _ in _stored_notifications()))
+        monkeypatch.setattr(worker, "_worker_running", False)
+        worker.notify_new_work()
+        await asyncio.wait_for(task, 5)
+        return fake
+
+    fake = asyncio.run(scenario())
+
+    assert [len(r) for r in fake.requests] == [20, 5]
+    assert _stored_message_ids() == {str(i) for i in range(25)}
+
+
+def test_stop_mid_batch_puts_claimed_notifications_back(worker_db, monkeypatch):
+    """Test that cancelling a stuck batch returns it and the prefetched batch to pending, attempts uncounted."""
+    monkeypatch.setattr(worker, "SHUTDOWN_GRACE_SECONDS", 0.05)
+    _save_notifications(25)
+
+    async def scenario():
+        fake = FakeGraphClient(hold=True)
+        _use_worker(monkeypatch, fake)
+        monkeypatch.setattr(worker, "_worker_task", asyncio.create_task(worker.worker_loop()))
+
+        await asyncio.wait_for(fake.fetching.wait(), 5)
+        await _wait_until(lambda: all(status == "processing" for status, _ in _stored_notifications()))
+        await worker.stop_worker()
+
+    asyncio.run(scenario())
+
+    assert _stored_notifications() == [("pending", 0)] * 25
+    assert _stored_message_ids() == set()
+
+
+def test_seen_messages_are_done_without_fetching(worker_db, monkeypatch):
+    """Test that notifications for messages already stored skip the Graph fetch."""
+    ids = _save_notifications(3)
+    worker._seen_message_ids["1"] = True
+
+    async def scenario():
+        fake = FakeGraphClient()
+        _use_worker(monkeypatch, fake)
+        await worker.process_batch(claim_pending_notifications())
+        return fake
+
+    fake = asyncio.run(scenario())
+
+    assert fake.requests == [["chats/c/messages/0", "chats/c/messages/2"]]
+    assert _stored_notifications() == [("done", 1)] * len(ids)
+    assert _stored_message_ids() == {"0", "2"}
+    assert "2" in worker._seen_message_ids
+
+
+def test_unexpected_error_body_fails_only_its_notification(worker_db, monkeypatch):
+    """Test that a sub-response with a non-dict error body fails its notification without breaking the batch."""
+    _save_notifications(2)
+
+    class OddErrorClient(FakeGraphClient):
+        async def get_messages_async(self, resource_paths):
+            responses = await super().get_messages_async(resource_paths)
+            responses[0] = {"id": "0", "status": 404, "body": "Not Found"}
+            return responses
+
+    async def scenario():
+        _use_worker(monkeypatch, OddErrorClient())
+        await worker.process_batch(claim_pending_notifications())
+
+    asyncio.run(scenario())
+
+    assert _stored_notifications() == [("pending", 1), ("done", 1)]
+    assert _stored_message_ids() == {"1"}
+
+
+def test_batch_is_released_when_its_failure_cannot_be_recorded(worker_db, monkeypatch):
+    """Test that a batch whose results and failure record both fail to store doesn't stay in processing."""
+    _save_notifications(2)
+
+    def broken_finalize(*args):
+        raise RuntimeError("disk I/O error")
+
+    monkeypatch.setattr(worker, "finalize_notification_batch", broken_finalize)
+
+    async def scenario():
+        _use_worker(monkeypatch, FakeGraphClient())
+        await worker.process_batch(claim_pending_notifications())
+
+    asyncio.run(scenario())
+
+    assert _stored_notifications() == [("pending", 0)] * 2